@@ -0,0 +1,511 @@
+"""Офлайн-бенчмарк конвейера Text2SQL
+
+Запускает приложение в процессе (без GPU и сети):
+- Ollama заменена локальным фейковым сервером (ASGI), который отдаёт
+  записанные SGR-ответы с настраиваемой задержкой;
+- PostgreSQL заменён SQLite в памяти с синтетическим "PurchaseAllView".
+
+Вопросы берутся из JSONL файлов (поле "question") и из журнала logs/.
+
+Пример:
+    python benchmark.py --concurrency 8 --requests 200 --ollama-delay 0.3
+"""
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import random
+import re
+import resource
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, Request
+
+BASE_DIR = Path(__file__).resolve().parent
+
+SYNTHETIC_QUESTIONS = [
+    "Покажи заявки по объекту Газопровод",
+    "Найди номенклатуры с лампами",
+    "Сколько позиций у Петрова в работе",
+    "Найди закупки по заявке ЛГ000000524",
+    "Покажи незакрытые позиции по кабелю",
+    "Какие заявки создал Иванов в этом году",
+]
+
+OBJECTS = ["Газопровод", "Котельная", "Насосная станция", "Склад №3", "Административный корпус"]
+NOMENCLATURE = ["Лампа светодиодная", "Кабель ВВГнг 3х2.5", "Труба стальная 57х3.5", "Задвижка клиновая", "Болт М12", "Краска эмаль ПФ-115"]
+USERS = [("petrov", "Петров Пётр Петрович"), ("ivanov", "Иванов Иван Иванович"), ("sidorova", "Сидорова Анна Сергеевна")]
+UNITS = ["шт", "м", "кг", "компл"]
+
+
+# --- Синтетическая база данных ---
+
+@functools.lru_cache(maxsize=1024)
+def _like_regex(pattern: str) -> "re.Pattern":
+    regex = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern)
+    return re.compile(regex, flags=re.IGNORECASE | re.DOTALL)
+
+
+def _like(pattern: str, value: Any, escape: Optional[str] = None) -> bool:
+    """Регистронезависимый LIKE с поддержкой кириллицы (ILIKE PostgreSQL)"""
+    if value is None or pattern is None:
+        return False
+    return _like_regex(pattern).fullmatch(str(value)) is not None
+
+
+def build_database(rows: int, seed: int) -> sqlite3.Connection:
+    """SQLite в памяти с синтетическим представлением PurchaseAllView"""
+    from database import SCHEMA_COLUMNS, TABLE_NAME
+
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("like", 2, _like, deterministic=True)
+    conn.create_function("like", 3, _like, deterministic=True)
+
+    columns = ", ".join(f'"{name}"' for name in SCHEMA_COLUMNS)
+    conn.execute(f'CREATE TABLE "{TABLE_NAME}" ({columns})')
+
+    start = datetime(2024, 1, 1)
+    data = []
+    for i in range(rows):
+        user, fio = rnd.choice(USERS)
+        nomenclature = rnd.choice(NOMENCLATURE)
+        order_date = start + timedelta(days=rnd.randint(0, 600))
+        quantity = rnd.randint(1, 500)
+        processed = rnd.randint(0, quantity)
+        record = {
+            "GlobalUid": f"uid-{i}",
+            "OrderNumber": f"ЛГ{i // 5:09d}",
+            "OrderDate": order_date.isoformat(),
+            "ApprovalDate": (order_date + timedelta(days=2)).isoformat(),
+            "ObjectName": rnd.choice(OBJECTS),
+            "Nomenclature": nomenclature,
+            "NomenclatureFullName": f"{nomenclature}, партия {rnd.randint(1, 99)}",
+            "ArtNumber": f"ART-{rnd.randint(1000, 9999)}",
+            "Quantity": quantity,
+            "RemainingQuantity": quantity - processed,
+            "ProcessedQuantity": processed,
+            "UnitName": rnd.choice(UNITS),
+            "ProcessingDate": (order_date + timedelta(days=5)).isoformat(),
+            "CompletedDate": None,
+            "UserName": user,
+            "Notes": "",
+            "ArchiveStatus": "",
+            "PurchaseRecordStatus": "A",
+            "PurchaseCardId": f"00000000-0000-0000-0000-{i:012d}",
+            "PurchaseNumber": f"З-{i}",
+            "PurchaseCardDate": order_date.isoformat(),
+            "PurchaseCardUserName": user,
+            "PurchaseCardUserFio": fio,
+        }
+        data.append(tuple(record[name] for name in SCHEMA_COLUMNS))
+
+    placeholders = ", ".join("?" for _ in SCHEMA_COLUMNS)
+    conn.executemany(f'INSERT INTO "{TABLE_NAME}" VALUES ({placeholders})', data)
+    conn.commit()
+    return conn
+
+
+def to_sqlite(sql: str) -> str:
+    """Грубый перевод PostgreSQL-диалекта сгенерированных запросов в SQLite"""
+    sql = re.sub(r"(?i)\bILIKE\b", "LIKE", sql)
+    sql = re.sub(r"::\w+", "", sql)
+    sql = re.sub(r"(?i)\bAS\s+numeric\b", "AS REAL", sql)
+    sql = re.sub(r"(?i)\bNOW\(\)", "CURRENT_TIMESTAMP", sql)
+    return sql.rstrip().rstrip(";")
+
+
+class _Cursor:
+    """Аналог курсора asyncpg: await, forward/fetch и асинхронная итерация"""
+
+    def __init__(self, conn: sqlite3.Connection, sql: str, prefetch: Optional[int] = None):
+        self._conn = conn
+        self._sql = sql
+        self._prefetch = prefetch or 100
+        self._cur = None
+
+    def _open(self):
+        if self._cur is None:
+            try:
+                self._cur = self._conn.execute(to_sqlite(self._sql))
+            except sqlite3.Error as e:
+                raise ValueError(str(e)) from e
+        return self
+
+    def __await__(self):
+        async def opened():
+            return self._open()
+        return opened().__await__()
+
+    async def forward(self, n: int):
+        self._cur.fetchmany(n)
+
+    async def fetch(self, n: int):
+        return self._cur.fetchmany(n)
+
+    def __aiter__(self):
+        self._open()
+        return self._iterate()
+
+    async def _iterate(self):
+        while True:
+            rows = self._cur.fetchmany(self._prefetch)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+class _Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class BenchConnection:
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def transaction(self, **kwargs):
+        return _Transaction()
+
+    def cursor(self, sql: str, prefetch: Optional[int] = None) -> _Cursor:
+        return _Cursor(self._conn, sql, prefetch)
+
+    async def execute(self, sql: str):
+        # SET LOCAL statement_timeout и EXPLAIN в SQLite не нужны
+        if sql.upper().startswith(("EXPLAIN", "SET ")):
+            return sql.split()[0].upper()
+        self._conn.execute(to_sqlite(sql))
+
+    async def fetch(self, sql: str):
+        cursor = self._conn.execute(to_sqlite(sql))
+        names = [column[0] for column in cursor.description]
+        return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    async def fetchval(self, sql: str):
+        match = re.match(r"(?is)^EXPLAIN\s*\([^)]*\)\s*(.*)$", sql)
+        if match:
+            count = self._conn.execute(f"SELECT COUNT(*) FROM ({to_sqlite(match.group(1))})").fetchone()[0]
+            return json.dumps([{"Plan": {"Plan Rows": count, "Total Cost": float(count)}}])
+        return self._conn.execute(to_sqlite(sql)).fetchone()[0]
+
+
+class BenchPool:
+    """Замена пула asyncpg поверх SQLite"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._connection = BenchConnection(conn)
+
+    def acquire(self):
+        pool = self
+
+        class _Acquire:
+            async def __aenter__(self):
+                return pool._connection
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Acquire()
+
+    async def close(self):
+        pass
+
+
+# --- Фейковый Ollama ---
+
+def fake_sgr_response(question: str, sql: str) -> Dict[str, Any]:
+    return {
+        "analysis": {
+            "user_intent": question,
+            "key_entities": [],
+            "search_terms": [],
+            "date_references": None,
+            "quantity_filters": None,
+        },
+        "strategy": {
+            "query_type": "filtered_select",
+            "target_fields": ["*"],
+            "where_conditions": [],
+            "grouping_fields": None,
+            "ordering": None,
+            "requires_aggregation": False,
+        },
+        "sql_query": sql,
+        "explanation": "Ответ из записи бенчмарка",
+        "confidence_score": 0.9,
+        "potential_issues": None,
+    }
+
+
+def default_sql(question: str) -> str:
+    words = [w for w in re.findall(r"\w{4,}", question.lower())]
+    term = words[-1][:5] if words else "ламп"
+    return (
+        'SELECT * FROM "PurchaseAllView" WHERE ("Nomenclature" ILIKE '
+        f"'%{term}%' OR \"ObjectName\" ILIKE '%{term}%' OR \"PurchaseCardUserFio\" ILIKE '%{term}%')"
+    )
+
+
+class FakeOllama:
+    """Локальный сервер, имитирующий /api/chat, /api/tags и /api/ps"""
+
+    def __init__(self, recordings: Dict[str, Dict[str, Any]], delay: float, jitter: float,
+                 bad_sql_rate: float, seed: int, models: List[str]):
+        self.recordings = recordings
+        self.delay = delay
+        self.jitter = jitter
+        self.bad_sql_rate = bad_sql_rate
+        self.random = random.Random(seed)
+        self.models = models
+        self.calls = 0
+        self.retries = 0
+        self.app = self._build_app()
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.get("/api/tags")
+        async def tags():
+            return {"models": [{"name": name, "size": 0, "details": {}} for name in self.models]}
+
+        @app.get("/api/ps")
+        async def ps():
+            return {"models": [{"name": name} for name in self.models]}
+
+        @app.post("/api/chat")
+        async def chat(request: Request):
+            payload = await request.json()
+            return await self.chat(payload)
+
+        return app
+
+    async def chat(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        self.calls += 1
+        messages = payload["messages"]
+        is_retry = len(messages) > 2
+        if is_retry:
+            self.retries += 1
+
+        question = ""
+        for message in messages:
+            match = re.search(r'ПОЛЬЗОВАТЕЛЬСКИЙ ЗАПРОС: "(.*)"', message["content"], flags=re.DOTALL)
+            if match:
+                question = match.group(1)
+
+        response = self.recordings.get(question) or fake_sgr_response(question, default_sql(question))
+        if not is_retry and self.random.random() < self.bad_sql_rate:
+            # Ошибка в имени поля — проверяется повторная генерация
+            response = dict(response, sql_query=response["sql_query"].replace('"Nomenclature"', '"Nomenclatura"'))
+
+        full_length = len(json.dumps(response, ensure_ascii=False))
+        if "analysis" not in payload.get("format", {}).get("properties", {}):
+            # Компактная схема: только поля, которые она требует
+            response = {key: response[key] for key in ("sql_query", "explanation", "confidence_score")}
+        content = json.dumps(response, ensure_ascii=False)
+
+        # Время генерации пропорционально длине ответа (число токенов вывода)
+        delay = self.delay * len(content) / full_length
+        await asyncio.sleep(max(0.0, delay + self.random.uniform(-self.jitter, self.jitter)))
+        return {
+            "model": payload["model"],
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "prompt_eval_count": sum(len(m["content"]) for m in messages) // 4,
+            "prompt_eval_duration": 1_000_000,
+            "eval_count": len(content) // 4,
+            "eval_duration": int(delay * 1e9),
+        }
+
+
+# --- Загрузка вопросов и записей ---
+
+def load_questions(paths: List[Path]) -> List[str]:
+    questions = []
+    for path in paths:
+        files = sorted(path.glob("*.jsonl")) if path.is_dir() else [path]
+        for file in files:
+            try:
+                with open(file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            item = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        if isinstance(item, dict) and item.get("question"):
+                            questions.append(item["question"])
+            except OSError as e:
+                logging.warning("Не удалось прочитать %s: %s", file, e)
+    return questions or list(SYNTHETIC_QUESTIONS)
+
+
+def load_recordings(paths: List[Path]) -> Dict[str, Dict[str, Any]]:
+    """Записанные ответы: {"question", "response"} или записи журнала с sql_query"""
+    recordings: Dict[str, Dict[str, Any]] = {}
+    for path in paths:
+        files = sorted(path.glob("*.jsonl")) if path.is_dir() else [path]
+        for file in files:
+            if not file.exists():
+                continue
+            with open(file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if not isinstance(item, dict) or not item.get("question"):
+                        continue
+                    if isinstance(item.get("response"), dict):
+                        recordings[item["question"]] = item["response"]
+                    elif item.get("sql_query"):
+                        recordings[item["question"]] = fake_sgr_response(item["question"], item["sql_query"])
+    return recordings
+
+
+# --- Прогон ---
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    lower = int(k)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (k - lower)
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    sys.path.insert(0, str(BASE_DIR))
+    import main
+    from log_store import LogStore
+
+    questions = load_questions(args.questions)
+    recordings = load_recordings(args.recordings)
+    fake = FakeOllama(recordings, args.ollama_delay, args.ollama_jitter, args.bad_sql_rate, args.seed, [args.model])
+
+    # Подмена внешних зависимостей приложения
+    main.db_manager.pool = BenchPool(build_database(args.rows, args.seed))
+    main.ollama_client.client = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=fake.app), base_url="http://ollama.bench", timeout=None,
+    )
+    await main.entity_index.refresh()
+    main.log_store = LogStore(Path(tempfile.mkdtemp(prefix="bench-logs-")))
+    await main.log_store.initialize()
+    if not args.cache:
+        main.query_cache.max_size = 0
+    main.query_cache.clear()
+    await main.model_registry.refresh()
+
+    rnd = random.Random(args.seed)
+    workload = [rnd.choice(questions) for _ in range(args.requests)]
+    latencies: List[float] = []
+    rows_serialized = 0
+    bytes_serialized = 0
+    failures = 0
+    queue: asyncio.Queue = asyncio.Queue()
+    for question in workload:
+        queue.put_nowait(question)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app.bench", timeout=None) as client:
+        async def worker():
+            nonlocal rows_serialized, bytes_serialized, failures
+            while not queue.empty():
+                question = queue.get_nowait()
+                started = time.perf_counter()
+                response = await client.post("/api/query", json={
+                    "question": question, "model": args.model, "result_format": args.result_format,
+                })
+                latencies.append(time.perf_counter() - started)
+                bytes_serialized += len(response.content)
+                if response.status_code != 200:
+                    failures += 1
+                    continue
+                data = response.json()
+                if data["confidence"] == 0.0 and not data["results"]:
+                    failures += 1
+                rows_serialized += len(data["results"])
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    await main.log_store.close()
+    await main.ollama_client.close()
+
+    return {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "failures": failures,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(args.requests / elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+            "mean": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        },
+        "llm_calls": fake.calls,
+        "retry_rate": round(fake.retries / args.requests, 4),
+        "rows_per_s": round(rows_serialized / elapsed, 1),
+        "bytes_per_s": round(bytes_serialized / elapsed, 1),
+        # ru_maxrss в Linux — килобайты
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "cache": main.query_cache.stats(),
+    }
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Text2SQL")
+    parser.add_argument("--requests", type=int, default=100, help="Число запросов")
+    parser.add_argument("--concurrency", type=int, default=4, help="Одновременных клиентов")
+    parser.add_argument("--model", default="qwen3:32b")
+    parser.add_argument("--questions", type=Path, nargs="*", default=[BASE_DIR / "logs"],
+                        help="JSONL файлы или каталоги с полем question")
+    parser.add_argument("--recordings", type=Path, nargs="*", default=[BASE_DIR / "logs"],
+                        help="JSONL с записанными ответами модели или записи журнала")
+    parser.add_argument("--rows", type=int, default=20000, help="Строк в синтетическом PurchaseAllView")
+    parser.add_argument("--ollama-delay", type=float, default=0.2, help="Задержка ответа модели, с")
+    parser.add_argument("--ollama-jitter", type=float, default=0.05)
+    parser.add_argument("--bad-sql-rate", type=float, default=0.1, help="Доля ответов с ошибкой в SQL")
+    parser.add_argument("--cache", action="store_true", help="Не отключать кэш вопрос → SQL")
+    parser.add_argument("--result-format", choices=("rows", "columnar"), default="rows",
+                        help="Формат строк в ответе /api/query")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=Path, help="Сохранить отчёт в JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="Завершиться с ошибкой, если p95 выше порога")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        args.output.write_text(text, encoding="utf-8")
+
+    if args.max_p95_ms is not None and report["latency_ms"]["p95"] > args.max_p95_ms:
+        print(f"p95 {report['latency_ms']['p95']} мс превышает порог {args.max_p95_ms} мс", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,383 @@
 import os
 import time
 import logging
-from typing import List, Dict, Any, Tuple
+import json
+import difflib
+from collections import OrderedDict
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple
 
 import asyncpg
 import dotenv
 import re
 
+import metrics
+from single_flight import SingleFlight
+from sgr_schema import DATABASE_SCHEMA
+
 dotenv.load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+TABLE_NAME = "PurchaseAllView"
+
+# Поля представления, объявленные в схеме для промпта: имя → тип
+SCHEMA_COLUMNS: Dict[str, str] = dict(re.findall(r'^- "(\w+)" \((\w+)\)', DATABASE_SCHEMA, flags=re.MULTILINE))
+
+# Схемы, в которых может быть указано представление: public."PurchaseAllView"
+ALLOWED_SCHEMAS = {"public", os.getenv("DATABASE_SCHEMA", "public").lower()}
+
+FORBIDDEN_KEYWORDS = {
+    'insert', 'update', 'delete', 'drop', 'create', 'alter', 'truncate', 'merge',
+    'grant', 'revoke', 'copy', 'into', 'call', 'do', 'vacuum', 'lock', 'set', 'reset',
+    'table',
+}
+# Разрешённые функции: всё, что не в списке, отклоняется (query_to_xml,
+# current_setting, pg_*, lo_* и т.п. дают доступ за пределы представления)
+ALLOWED_FUNCTIONS = {
+    # агрегаты и оконные функции
+    'count', 'sum', 'avg', 'min', 'max', 'string_agg', 'array_agg', 'bool_and', 'bool_or', 'every',
+    'stddev', 'stddev_pop', 'stddev_samp', 'variance', 'var_pop', 'var_samp',
+    'percentile_cont', 'percentile_disc', 'mode',
+    'row_number', 'rank', 'dense_rank', 'percent_rank', 'cume_dist', 'ntile',
+    'lag', 'lead', 'first_value', 'last_value', 'nth_value',
+    # условные
+    'coalesce', 'nullif', 'greatest', 'least',
+    # строки
+    'lower', 'upper', 'initcap', 'length', 'char_length', 'character_length', 'octet_length',
+    'trim', 'ltrim', 'rtrim', 'btrim', 'substring', 'substr', 'left', 'right', 'position', 'strpos',
+    'replace', 'concat', 'concat_ws', 'split_part', 'regexp_replace', 'regexp_match', 'regexp_matches',
+    'translate', 'lpad', 'rpad', 'reverse', 'starts_with',
+    # числа
+    'abs', 'round', 'ceil', 'ceiling', 'floor', 'trunc', 'mod', 'power', 'sqrt', 'sign', 'div',
+    # даты
+    'now', 'date_trunc', 'date_part', 'extract', 'age', 'to_char', 'to_date', 'to_timestamp',
+    'to_number', 'make_date', 'make_interval', 'date',
+}
+# Ключевые слова и типы, после которых допустима скобка
+PAREN_KEYWORDS = {
+    'select', 'with', 'as', 'from', 'join', 'on', 'using', 'where', 'and', 'or', 'not', 'in', 'exists',
+    'any', 'all', 'some', 'array', 'row', 'values', 'over', 'filter', 'within', 'group', 'by', 'having',
+    'order', 'partition', 'case', 'when', 'then', 'else', 'distinct', 'between', 'like', 'ilike',
+    'union', 'except', 'intersect', 'limit', 'offset', 'lateral', 'cast', 'is', 'recursive', 'materialized',
+    'numeric', 'decimal', 'varchar', 'char', 'character', 'timestamp', 'time', 'interval',
+}
+# Слова, которые завершают источник в FROM (а не являются его псевдонимом)
+_CLAUSE_WORDS = {
+    'where', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'on', 'using',
+    'group', 'order', 'limit', 'offset', 'having', 'union', 'except', 'intersect', 'window', 'fetch', 'for',
+}
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<space>\s+)
+    |(?P<comment>--[^\n]*|/\*.*?\*/)
+    |(?P<string>[Ee]'(?:[^'\\]|\\.|'')*'|(?:[Uu]&)?'(?:[^']|'')*')
+    |(?P<ident>"(?:[^"]|"")+")
+    |(?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    |(?P<word>[^\W\d]\w*)
+    |(?P<param>\$\d+)
+    |(?P<op>::|<=|>=|<>|!=|\|\||[-+*/%<>=(),.;\[\]~!@#^&|?:])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def tokenize_sql(sql: str) -> List[Tuple[str, str, int]]:
+    """Разбиение SQL на токены (тип, значение, позиция) без пробелов и комментариев"""
+    tokens = []
+    pos = 0
+    while pos < len(sql):
+        match = _TOKEN_RE.match(sql, pos)
+        if match is None:
+            raise SQLValidationError([{
+                "code": "syntax",
+                "message": f"Не удалось разобрать SQL около позиции {pos}: {sql[pos:pos + 20]!r}",
+            }])
+        kind = match.lastgroup
+        if kind not in ("space", "comment"):
+            value = match.group()
+            if kind == "ident":
+                value = value[1:-1].replace('""', '"')
+            tokens.append((kind, value, pos))
+        pos = match.end()
+    return tokens
+
+
+def normalize_sql_key(sql: str) -> str:
+    """Ключ SQL без учёта пробелов, комментариев и регистра ключевых слов"""
+    parts = []
+    for kind, value, _ in tokenize_sql(sql):
+        if kind == "word":
+            parts.append(value.lower())
+        elif kind == "ident":
+            parts.append('"' + value.replace('"', '""') + '"')
+        elif value != ";":
+            parts.append(value)
+    return " ".join(parts)
+
+
+class CostTier(NamedTuple):
+    """Уровень стоимости запроса по оценке планировщика и его бюджеты"""
+    name: str
+    max_cost: float
+    timeout_s: float
+    row_cap: int  # 0 — без отдельного ограничения (действует MAX_RESULTS)
+
+
+DEFAULT_COST_TIERS = "fast:10000:5:0,medium:200000:15:2000,heavy:2000000:30:500"
+
+
+def parse_cost_tiers(value: str) -> List[CostTier]:
+    """Разбор строки вида "имя:стоимость:таймаут_с:строк,..." """
+    tiers = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, max_cost, timeout_s, row_cap = item.split(":")
+        tiers.append(CostTier(name, float(max_cost), float(timeout_s), int(row_cap)))
+    return sorted(tiers, key=lambda tier: tier.max_cost)
+
+
+class SQLValidationError(ValueError):
+    """Ошибка локальной проверки SQL; errors содержит список проблем для повторного промпта"""
+
+    def __init__(self, errors: List[Dict[str, str]]):
+        self.errors = errors
+        super().__init__("; ".join(error["message"] for error in errors))
+
+
+def _skip_parens(tokens: List[Tuple[str, str, int]], i: int) -> int:
+    """Позиция после скобки, закрывающей открытую в tokens[i]"""
+    depth = 0
+    for j in range(i, len(tokens)):
+        if tokens[j][0] == "op" and tokens[j][1] == "(":
+            depth += 1
+        elif tokens[j][0] == "op" and tokens[j][1] == ")":
+            depth -= 1
+            if depth == 0:
+                return j + 1
+    return len(tokens)
+
+
+def _starts_query(tokens: List[Tuple[str, str, int]], i: int) -> bool:
+    return i < len(tokens) and tokens[i][0] == "word" and tokens[i][1].lower() in ("select", "with")
+
+
+def _cte_names(tokens: List[Tuple[str, str, int]]) -> Tuple[set, set]:
+    """Имена CTE из списков WITH [RECURSIVE] name [(...)] AS [[NOT] MATERIALIZED] (...), ...
+
+    Возвращает имена (в нижнем регистре) и позиции токенов-имён в объявлениях.
+    """
+    names, positions = set(), set()
+    for start, (kind, value, _) in enumerate(tokens):
+        if kind != "word" or value.lower() != "with" or (start > 0 and tokens[start - 1][:2] != ("op", "(")):
+            continue
+        i = start + 1
+        if i < len(tokens) and tokens[i][0] == "word" and tokens[i][1].lower() == "recursive":
+            i += 1
+        while i < len(tokens) and tokens[i][0] in ("ident", "word"):
+            name_pos = i
+            i += 1
+            if i < len(tokens) and tokens[i][:2] == ("op", "("):
+                i = _skip_parens(tokens, i)
+            if not (i < len(tokens) and tokens[i][0] == "word" and tokens[i][1].lower() == "as"):
+                break
+            i += 1
+            while i < len(tokens) and tokens[i][0] == "word" and tokens[i][1].lower() in ("not", "materialized"):
+                i += 1
+            if not (i < len(tokens) and tokens[i][:2] == ("op", "(")):
+                break
+            names.add(tokens[name_pos][1].lower())
+            positions.add(name_pos)
+            i = _skip_parens(tokens, i)
+            if not (i < len(tokens) and tokens[i][:2] == ("op", ",")):
+                break
+            i += 1
+    return names, positions
+
+
+def _parse_sources(tokens: List[Tuple[str, str, int]], i: int, many: bool, cte_names: set):
+    """Разбор источников после FROM (через запятую) или JOIN, начиная с tokens[i]
+
+    Возвращает позиции токенов-имён таблиц и список недопустимых источников.
+    """
+    positions: List[int] = []
+    rejected: List[str] = []
+    while i < len(tokens):
+        kind, value, _ = tokens[i]
+        if kind == "word" and value.lower() == "lateral":
+            i += 1
+            continue
+        if kind == "op" and value == "(":
+            if _starts_query(tokens, i + 1):
+                # Подзапрос: его содержимое проверяется основным проходом
+                i = _skip_parens(tokens, i)
+            else:
+                # Соединение в скобках: (a JOIN b ON ...) не разрешается
+                rejected.append("(...)")
+                i = _skip_parens(tokens, i)
+        elif kind in ("ident", "word"):
+            parts = [(kind, value)]
+            positions.append(i)
+            i += 1
+            while (i + 1 < len(tokens) and tokens[i][:2] == ("op", ".")
+                   and tokens[i + 1][0] in ("ident", "word")):
+                parts.append(tokens[i + 1][:2])
+                positions.append(i + 1)
+                i += 2
+            name = ".".join(part for _, part in parts)
+            if i < len(tokens) and tokens[i][:2] == ("op", "("):
+                rejected.append(name + "(...)")
+                i = _skip_parens(tokens, i)
+            elif not _is_allowed_source(parts, cte_names):
+                rejected.append(name)
+        else:
+            rejected.append(value)
+            break
+
+        # Псевдоним источника и список имён столбцов
+        if i < len(tokens) and tokens[i][0] == "word" and tokens[i][1].lower() == "as":
+            i += 1
+        if i < len(tokens) and (
+            tokens[i][0] == "ident" or (tokens[i][0] == "word" and tokens[i][1].lower() not in _CLAUSE_WORDS)
+        ):
+            positions.append(i)
+            i += 1
+            if i < len(tokens) and tokens[i][:2] == ("op", "("):
+                i = _skip_parens(tokens, i)
+
+        if many and i < len(tokens) and tokens[i][:2] == ("op", ","):
+            i += 1
+            continue
+        break
+    return positions, rejected
+
+
+def _is_allowed_source(parts: List[Tuple[str, str]], cte_names: set) -> bool:
+    def is_table(kind: str, name: str) -> bool:
+        return name == TABLE_NAME or (kind == "word" and name.lower() == TABLE_NAME.lower())
+
+    if len(parts) == 1:
+        kind, name = parts[0]
+        return is_table(kind, name) or name.lower() in cte_names
+    if len(parts) == 2:
+        (schema_kind, schema), (kind, name) = parts
+        schema = schema if schema_kind == "ident" else schema.lower()
+        return schema in ALLOWED_SCHEMAS and is_table(kind, name)
+    return False
+
+
+def validate_sql(sql: str) -> List[Dict[str, str]]:
+    """Проверка SQL без обращения к БД
+
+    Разрешён один SELECT (или WITH ... SELECT) к PurchaseAllView: каждый
+    источник в FROM/JOIN — представление, CTE или подзапрос, функции — только
+    из ALLOWED_FUNCTIONS; все идентификаторы в кавычках должны быть полями
+    из DATABASE_SCHEMA или псевдонимами, объявленными в самом запросе.
+    """
+    tokens = tokenize_sql(sql)
+    errors: List[Dict[str, str]] = []
+
+    def add(code: str, message: str) -> None:
+        if not any(e["message"] == message for e in errors):
+            errors.append({"code": code, "message": message})
+
+    if not tokens:
+        return [{"code": "empty", "message": "Пустой SQL запрос"}]
+
+    first = tokens[0][1].lower() if tokens[0][0] == "word" else ""
+    if first not in ("select", "with"):
+        add("not_select", "Разрешены только SELECT запросы")
+
+    # Псевдонимы полей и имена CTE, объявленные в запросе
+    aliases = set()
+    for i, (kind, value, _) in enumerate(tokens):
+        if kind == "word" and value.lower() == "as" and i + 1 < len(tokens):
+            next_kind, next_value, _ = tokens[i + 1]
+            if next_kind in ("ident", "word"):
+                aliases.add(next_value)
+    cte_names, cte_positions = _cte_names(tokens)
+
+    columns_lower = {name.lower(): name for name in SCHEMA_COLUMNS}
+    uses_table = False
+    # Для каждой открытой скобки: проверяются ли в ней FROM/JOIN. Не
+    # проверяются только аргументы функций: EXTRACT(YEAR FROM ...), TRIM(... FROM ...)
+    paren_stack: List[bool] = []
+    # Позиции имён таблиц (и схем), их псевдонимов и имён CTE — это не поля и не функции
+    source_positions = set(cte_positions)
+
+    for i, (kind, value, _) in enumerate(tokens):
+        next_token = tokens[i + 1] if i + 1 < len(tokens) else None
+        lower = value.lower()
+
+        if kind == "op" and value == ";":
+            if next_token is not None:
+                add("multiple_statements", "Разрешён только один SQL запрос")
+        elif kind == "op" and value == "(":
+            previous = tokens[i - 1] if i > 0 else None
+            function_call = (
+                previous is not None
+                and (previous[0] == "ident" or (previous[0] == "word" and previous[1].lower() not in PAREN_KEYWORDS))
+                and not _starts_query(tokens, i + 1)
+            )
+            paren_stack.append(not function_call)
+        elif kind == "op" and value == ")":
+            if paren_stack:
+                paren_stack.pop()
+        elif i in source_positions:
+            if (kind == "ident" and value == TABLE_NAME) or (kind == "word" and lower == TABLE_NAME.lower()):
+                uses_table = True
+        elif kind in ("word", "ident") and next_token is not None and next_token[:2] == ("op", "("):
+            # Вызов функции: только из списка разрешённых
+            name = lower if kind == "word" else value
+            if kind == "word" and lower in FORBIDDEN_KEYWORDS:
+                add("forbidden", f"Запрещённая операция: {value.upper()}")
+            elif not (name in ALLOWED_FUNCTIONS or (kind == "word" and lower in PAREN_KEYWORDS)):
+                add("forbidden_function", f"Функция {value} не разрешена")
+        elif kind == "word":
+            if lower in FORBIDDEN_KEYWORDS:
+                add("forbidden", f"Запрещённая операция: {value.upper()}")
+            elif lower == TABLE_NAME.lower():
+                uses_table = True
+            elif lower in ("from", "join") and (not paren_stack or paren_stack[-1]):
+                # Источники данных: только PurchaseAllView, CTE или подзапрос
+                positions, rejected = _parse_sources(tokens, i + 1, lower == "from", cte_names)
+                source_positions.update(positions)
+                if not positions and not rejected and next_token is None:
+                    rejected.append("")
+                for source in rejected:
+                    add("unknown_table", f"Неизвестная таблица {source!r}: разрешена только \"{TABLE_NAME}\"")
+            elif lower in columns_lower and value not in aliases:
+                add("unquoted_column", f"Поле {value} нужно писать в двойных кавычках: \"{columns_lower[lower]}\"")
+        elif kind == "ident":
+            if value == TABLE_NAME:
+                uses_table = True
+            elif value not in SCHEMA_COLUMNS and value not in aliases and value.lower() not in cte_names:
+                suggestion = difflib.get_close_matches(value, list(SCHEMA_COLUMNS), n=1)
+                hint = f", возможно имелось в виду \"{suggestion[0]}\"" if suggestion else ""
+                add("unknown_column", f"Неизвестное поле \"{value}\"{hint}")
+
+    if not uses_table:
+        add("missing_table", f"Запросы должны использовать таблицу {TABLE_NAME}")
+
+    return errors
+
 class DatabaseManager:
     def __init__(self):
         self.connection_string = self._build_connection_string()
         self.pool = None
+        # Жёсткий предел числа строк, загружаемых в память за один вызов
+        self.max_results = int(os.getenv("MAX_RESULTS", 5000))
+        # Оценка стоимости через EXPLAIN перед выполнением и бюджеты по уровням
+        self.cost_guard = os.getenv("SQL_COST_GUARD", "true").lower() == "true"
+        self.cost_tiers = parse_cost_tiers(os.getenv("SQL_COST_TIERS", DEFAULT_COST_TIERS))
+        # Оценки числа строк из последних планов: SQL → Plan Rows
+        self._plan_rows: "OrderedDict[str, int]" = OrderedDict()
+        # Бюджет строк уровня стоимости из последних проверок: SQL → row_cap
+        self._row_caps: "OrderedDict[str, int]" = OrderedDict()
+        # Одинаковые одновременные запросы выполняются в БД один раз
+        self._inflight = SingleFlight("db")
     
     def _build_connection_string(self) -> str:
         return (
@@ -40,46 +403,136 @@ class DatabaseManager:
             logger.error(f"Ошибка подключения к БД: {e}")
             raise
     
-    async def execute_query(self, sql: str) -> Tuple[List[Dict[str, Any]], str]:
-        """Выполнение SQL запроса с ограничениями безопасности
-
-        Возвращает результаты выполнения и фактический SQL после нормализации.
-        """
+    def prepare_query(self, sql: str) -> str:
+        """Нормализация и проверка безопасности SQL перед выполнением"""
 
         # Предварительная нормализация запроса
         sql = self._normalize_query(sql)
 
-        # Базовая валидация SQL
-        sql_lower = sql.lower().strip()
-        
-        # Запрещенные операции
-        forbidden = ['insert', 'update', 'delete', 'drop', 'create', 'alter', 'truncate']
-        if any(word in sql_lower for word in forbidden):
-            raise ValueError("Запрещены операции изменения данных")
-        
-        # Обязательное указание таблицы
-        if 'purchaseallview' not in sql_lower:
-            raise ValueError("Запросы должны использовать таблицу PurchaseAllView")
-
         # Корректное написание названия таблицы
-        if '"purchaseallview"' not in sql_lower:
-            sql = re.sub(r'(?i)purchaseallview', '"PurchaseAllView"', sql)
+        if f'"{TABLE_NAME.lower()}"' not in sql.lower():
+            sql = re.sub(r'(?i)\bpurchaseallview\b', f'"{TABLE_NAME}"', sql)
+
+        # Локальная проверка по токенам: только SELECT, известные поля и таблица
+        errors = validate_sql(sql)
+        if errors:
+            raise SQLValidationError(errors)
         
         # Не добавляем LIMIT автоматически, выполняем запрос как есть
+        return sql
 
-        logger.info("Executing SQL: %s", sql)
+    async def fetch_records(self, sql: str, offset: int = 0, limit: Optional[int] = None) -> Tuple[List[asyncpg.Record], str]:
+        """Выполнение SQL запроса с ограничениями безопасности
+
+        Возвращает записи asyncpg как есть и фактический SQL после нормализации.
+        Строки читаются серверным курсором, начиная с offset, не более
+        limit (и не более MAX_RESULTS) штук. Одновременные вызовы с тем же
+        SQL и окном строк ждут одно выполнение (список записей общий).
+        """
+        with metrics.timed("sql_prepare"):
+            sql = self.prepare_query(sql)
+        limit = self.max_results if limit is None else min(limit, self.max_results)
+        key = (normalize_sql_key(sql), offset, limit)
+        return await self._inflight.do(key, lambda: self._fetch(sql, offset, limit))
+
+    async def _fetch(self, sql: str, offset: int, limit: int) -> Tuple[List[asyncpg.Record], str]:
+        logger.info("Executing SQL: %s (offset=%d, limit=%d)", sql, offset, limit)
 
         try:
             async with self.pool.acquire() as connection:
                 start_time = time.perf_counter()
-                result = await connection.fetch(sql)
+                # Курсоры в PostgreSQL работают только внутри транзакции
+                async with connection.transaction(readonly=True):
+                    tier = await self._apply_cost_guard(connection, sql)
+                    if tier is not None and tier.row_cap:
+                        # Бюджет строк действует на весь результат, а не на страницу
+                        limit = max(0, min(limit, tier.row_cap - offset))
+                    result = []
+                    if limit:
+                        cursor = await connection.cursor(sql)
+                        if offset:
+                            await cursor.forward(offset)
+                        result = await cursor.fetch(limit)
                 duration = time.perf_counter() - start_time
+                metrics.record("db", duration)
                 logger.info("SQL execution took %.3f seconds", duration)
-                return [dict(row) for row in result], sql
-                
+                return result, sql
+
+        except SQLValidationError:
+            raise
+        except asyncpg.exceptions.QueryCanceledError as e:
+            logger.error(f"Превышен лимит времени SQL: {e}")
+            raise ValueError(
+                "Ошибка SQL: запрос превысил лимит времени выполнения. "
+                "Сузь условия отбора или используй более точные условия вместо ILIKE '%...%'"
+            )
         except Exception as e:
             logger.error(f"Ошибка выполнения SQL: {e}")
             raise ValueError(f"Ошибка SQL: {str(e)}")
+
+    async def _explain(self, connection, sql: str) -> Dict[str, Any]:
+        """Корневой узел плана EXPLAIN (FORMAT JSON) — без выполнения запроса"""
+        with metrics.timed("db_explain"):
+            plan = await connection.fetchval(f"EXPLAIN (FORMAT JSON) {sql}")
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        root = plan[0]["Plan"]
+        self._plan_rows[sql] = int(root["Plan Rows"])
+        self._plan_rows.move_to_end(sql)
+        while len(self._plan_rows) > 256:
+            self._plan_rows.popitem(last=False)
+        return root
+
+    async def _apply_cost_guard(self, connection, sql: str) -> Optional[CostTier]:
+        """Классификация запроса по стоимости плана и установка statement_timeout
+
+        Вызывается внутри транзакции: SET LOCAL действует до её завершения.
+        Слишком дорогой запрос отклоняется с пояснением для повторной генерации.
+        """
+        if not self.cost_guard or not self.cost_tiers:
+            return None
+
+        root = await self._explain(connection, sql)
+        cost = float(root["Total Cost"])
+        tier = next((t for t in self.cost_tiers if cost <= t.max_cost), None)
+        if tier is None:
+            raise SQLValidationError([{
+                "code": "too_expensive",
+                "message": (
+                    f"Запрос слишком тяжёлый (оценка стоимости {cost:.0f}, примерно {root['Plan Rows']} строк). "
+                    "Сузь условия: добавь фильтры по объекту, дате или номеру заявки, "
+                    "не ищи ILIKE '%...%' сразу по многим текстовым полям"
+                ),
+            }])
+
+        logger.info("SQL cost %.0f → tier %s (timeout %.0f s, rows %s)",
+                    cost, tier.name, tier.timeout_s, tier.row_cap or self.max_results)
+        await connection.execute(f"SET LOCAL statement_timeout = {int(tier.timeout_s * 1000)}")
+        if tier.row_cap:
+            self._row_caps[sql] = tier.row_cap
+            self._row_caps.move_to_end(sql)
+            while len(self._row_caps) > 256:
+                self._row_caps.popitem(last=False)
+        else:
+            self._row_caps.pop(sql, None)
+        return tier
+
+    def row_cap(self, sql: str) -> Optional[int]:
+        """Бюджет строк, применённый к запросу при последнем выполнении (None — без ограничения уровня)"""
+        return self._row_caps.get(sql)
+
+    async def estimate_count(self, sql: str) -> Optional[int]:
+        """Оценка числа строк результата по плану запроса (без выполнения)"""
+        sql = self.prepare_query(sql)
+        if sql in self._plan_rows:
+            return self._plan_rows[sql]
+        try:
+            async with self.pool.acquire() as connection:
+                root = await self._explain(connection, sql)
+            return int(root["Plan Rows"])
+        except Exception as e:
+            logger.warning("Не удалось оценить число строк: %s", e)
+            return None
     
     async def close(self):
         """Закрытие пула соединений"""
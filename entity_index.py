@@ -0,0 +1,239 @@
+import asyncio
+import logging
+import os
+import re
+import time
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+from database import DatabaseManager, TABLE_NAME
+
+logger = logging.getLogger(__name__)
+
+# Поля, значения которых загружаются в индекс
+INDEXED_COLUMNS = ("ObjectName", "Nomenclature", "UserName", "PurchaseCardUserFio", "OrderNumber")
+
+_WORD_RE = re.compile(r"\w+")
+_ILIKE_RE = re.compile(r'"(\w+)"\s+ILIKE\s+\'%', re.IGNORECASE)
+# Слова вопроса, которые не являются поисковыми терминами
+STOP_WORDS = {
+    "покажи", "найди", "найти", "выведи", "сколько", "какие", "какая", "какой", "все", "всех",
+    "заявки", "заявка", "заявке", "заявку", "заявок", "позиции", "позиций", "закупки", "закупок",
+    "номенклатура", "номенклатуры", "объекту", "объект", "объекта", "пользователя", "работе",
+    "году", "месяц", "месяце", "этом", "прошлом", "для", "что", "где", "или", "есть", "нет",
+}
+
+
+def _normalize(text: str) -> str:
+    return text.lower().replace("ё", "е")
+
+
+def trigrams(text: str, stem: bool = False) -> List[str]:
+    """Триграммы слов текста (с границами слов, как в pg_trgm)
+
+    stem=True — для поисковых терминов: окончание длинных слов отбрасывается,
+    а конец слова не фиксируется, чтобы "лампами" находило "Лампа".
+    """
+    result = []
+    for word in _WORD_RE.findall(_normalize(text)):
+        if stem:
+            padded = "  " + (word[:-2] if len(word) > 5 and word.isalpha() else word)
+        else:
+            padded = f"  {word} "
+        result.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class ColumnIndex:
+    """Различные значения одного поля с компактными триграммными списками
+
+    Триграммы, встречающиеся больше чем в max_postings значениях, при поиске
+    пропускаются: они почти ничего не различают, а подсчёт по ним — основная
+    стоимость поиска на больших индексах.
+    """
+
+    def __init__(self, column: str, values: List[str], max_postings: int = 20000):
+        self.column = column
+        self.values = values
+        self.max_postings = max_postings
+        self.postings: Dict[str, array] = {}
+        self.exact: Dict[str, int] = {}
+        for value_id, value in enumerate(values):
+            self.exact.setdefault(_normalize(value), value_id)
+            for gram in set(trigrams(value)):
+                postings = self.postings.get(gram)
+                if postings is None:
+                    postings = self.postings[gram] = array("I")
+                postings.append(value_id)
+
+    def search(self, term: str, min_score: float = 0.75, limit: int = 5) -> List[Tuple[str, float]]:
+        """Значения, содержащие большую часть триграмм термина"""
+        value_id = self.exact.get(_normalize(term))
+        if value_id is not None:
+            return [(self.values[value_id], 1.0)]
+        grams = set(trigrams(term, stem=True))
+        if not grams:
+            return []
+        hits: Counter = Counter()
+        considered = len(grams)
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings is None:
+                continue
+            if len(postings) > self.max_postings:
+                considered -= 1
+                continue
+            hits.update(postings)
+        if not hits:
+            return []
+
+        needed = considered * min_score
+        candidates = [(value_id, count) for value_id, count in hits.items() if count >= needed]
+        # Сначала наибольшее совпадение, затем более короткие (более точные) значения
+        candidates.sort(key=lambda item: (-item[1], len(self.values[item[0]])))
+        return [(self.values[value_id], round(count / considered, 3)) for value_id, count in candidates[:limit]]
+
+
+class EntityIndex:
+    """Индекс известных значений объектов, номенклатуры, пользователей и заявок
+
+    Загружается при старте и обновляется в фоне. Позволяет до генерации
+    сопоставить слова вопроса с точными значениями из базы и подсказать
+    модели сравнение "=" / IN вместо ILIKE '%...%'.
+    """
+
+    def __init__(self, db_manager: DatabaseManager):
+        self.db_manager = db_manager
+        self.refresh_interval = float(os.getenv("ENTITY_INDEX_REFRESH", 3600))
+        self.max_values = int(os.getenv("ENTITY_INDEX_MAX_VALUES", 200000))
+        self.max_postings = int(os.getenv("ENTITY_INDEX_MAX_POSTINGS", 20000))
+        self.enabled = os.getenv("ENTITY_INDEX_ENABLED", "true").lower() == "true"
+        self.columns: Dict[str, ColumnIndex] = {}
+        self.refreshed_at: Optional[float] = None
+        # Сколько раз поле встречалось в ILIKE '%...' выполненных запросов
+        self.ilike_usage: Counter = Counter()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Запуск загрузки в фоне: приложение не ждёт сканирования значений,
+        а prompt_hints до первой загрузки возвращает пустую строку"""
+        if not self.enabled:
+            return
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Ошибка обновления индекса сущностей: %s", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    async def refresh(self):
+        """Загрузка различных значений полей и построение индексов"""
+        started = time.perf_counter()
+        loaded: Dict[str, List[str]] = {}
+        async with self.db_manager.pool.acquire() as connection:
+            for column in INDEXED_COLUMNS:
+                rows = await connection.fetch(
+                    f'SELECT DISTINCT "{column}" AS value FROM "{TABLE_NAME}" '
+                    f'WHERE "{column}" IS NOT NULL AND "{column}" <> \'\' LIMIT {self.max_values}'
+                )
+                loaded[column] = [row["value"] for row in rows]
+
+        # Построение триграмм — чистая работа CPU, выносим из event loop
+        self.columns = await asyncio.to_thread(
+            lambda: {column: ColumnIndex(column, values, self.max_postings) for column, values in loaded.items()}
+        )
+        self.refreshed_at = time.time()
+        logger.info(
+            "Индекс сущностей построен за %.2f с: %s",
+            time.perf_counter() - started,
+            {column: len(index.values) for column, index in self.columns.items()},
+        )
+
+    def candidate_terms(self, question: str) -> List[str]:
+        return [
+            word for word in _WORD_RE.findall(question)
+            if len(word) >= 3 and _normalize(word) not in STOP_WORDS
+        ]
+
+    def resolve(self, terms: List[str], limit: int = 5) -> Dict[str, Dict[str, List[Tuple[str, float]]]]:
+        """Сопоставление терминов (например, QueryAnalysis.search_terms) с известными значениями
+
+        Возвращает {термин: {поле: [(значение, оценка), ...]}}.
+        """
+        result: Dict[str, Dict[str, List[Tuple[str, float]]]] = {}
+        for term in terms:
+            matches = {}
+            for column, index in self.columns.items():
+                found = index.search(term, limit=limit)
+                if found:
+                    matches[column] = found
+            if matches:
+                result[term] = matches
+        return result
+
+    def prompt_hints(self, question: str, limit: int = 5) -> str:
+        """Блок подсказок с точными значениями для сообщения пользователя
+
+        Поиск по индексу — работа CPU: из async кода вызывается через asyncio.to_thread.
+        """
+        if not self.columns:
+            return ""
+        resolved = self.resolve(self.candidate_terms(question), limit=limit)
+        if not resolved:
+            return ""
+
+        by_column: Dict[str, List[str]] = {}
+        for matches in resolved.values():
+            for column, values in matches.items():
+                known = by_column.setdefault(column, [])
+                known.extend(value for value, _ in values if value not in known)
+
+        lines = ["ИЗВЕСТНЫЕ ЗНАЧЕНИЯ ИЗ БАЗЫ (если подходят, используй точное сравнение = или IN вместо ILIKE):"]
+        for column, values in by_column.items():
+            quoted = ", ".join("'" + value.replace("'", "''") + "'" for value in values[:limit])
+            lines.append(f'- "{column}": {quoted}')
+        return "\n".join(lines)
+
+    def observe_sql(self, sql: str) -> None:
+        """Учёт полей, по которым выполняется ILIKE с ведущим '%'"""
+        self.ilike_usage.update(_ILIKE_RE.findall(sql))
+
+    def trgm_advice(self) -> List[Dict[str, Any]]:
+        """Какие pg_trgm индексы ускорили бы оставшиеся ILIKE '%...%'"""
+        advice = []
+        for column, count in self.ilike_usage.most_common():
+            advice.append({
+                "column": column,
+                "ilike_queries": count,
+                # PurchaseAllView — представление: индекс создаётся на базовой таблице
+                "ddl": (
+                    "CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+                    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{column.lower()}_trgm '
+                    f'ON <базовая таблица> USING gin ("{column}" gin_trgm_ops);'
+                ),
+            })
+        return advice
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "refreshed_at": self.refreshed_at,
+            "columns": {
+                column: {"values": len(index.values), "trigrams": len(index.postings)}
+                for column, index in self.columns.items()
+            },
+            "trgm_advice": self.trgm_advice(),
+        }
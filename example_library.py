@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from query_cache import normalize_question
+
+try:
+    import numpy as np
+except ImportError:  # без NumPy в промпт попадают только статические примеры
+    np = None
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZES = (3, 4)
+
+
+class Example(NamedTuple):
+    question: str
+    sql: str
+    gram_ids: Any  # np.ndarray[int32]
+    counts: Any  # np.ndarray[float32]
+
+
+class _Matrix(NamedTuple):
+    """Снимок индекса: TF-IDF веса, сгруппированные по n-граммам (CSC)"""
+    examples: List[Example]
+    idf: Any
+    indptr: Any
+    doc_ids: Any
+    weights: Any
+
+
+class ExampleLibrary:
+    """Библиотека примеров вопрос → SQL из успешных запросов журнала
+
+    Вопросы представлены TF-IDF векторами по символьным n-граммам; для
+    нового вопроса выбираются top-k ближайших по косинусу. Новые примеры
+    разбиваются на n-граммы сразу, а веса пересчитываются векторно в
+    потоке с небольшой задержкой, пачкой.
+    """
+
+    def __init__(self):
+        self.enabled = np is not None and os.getenv("EXAMPLE_LIBRARY_ENABLED", "true").lower() == "true"
+        self.max_examples = int(os.getenv("EXAMPLE_LIBRARY_SIZE", 2000))
+        self.top_k = int(os.getenv("EXAMPLE_TOP_K", 3))
+        self.min_score = float(os.getenv("EXAMPLE_MIN_SCORE", 0.3))
+        self.min_confidence = float(os.getenv("EXAMPLE_MIN_CONFIDENCE", 0.7))
+        self.rebuild_delay = float(os.getenv("EXAMPLE_REBUILD_DELAY", 1.0))
+
+        self._vocab: Dict[str, int] = {}
+        # Нормализованный вопрос → пример (последний успешный SQL)
+        self._examples: "OrderedDict[str, Example]" = OrderedDict()
+        self._matrix: Optional[_Matrix] = None
+        self._rebuild_task: Optional[asyncio.Task] = None
+        if np is None:
+            logger.warning("NumPy не установлен: динамический подбор примеров отключён")
+
+    async def load(self, entries: List[Dict[str, Any]]) -> None:
+        """Начальное заполнение из записей журнала (от новых к старым)"""
+        if not self.enabled:
+            return
+        for entry in reversed(entries):
+            self._add(entry.get("question", ""), entry.get("sql_query", ""), entry.get("confidence", 0.0))
+        await asyncio.to_thread(self._build, list(self._examples.values()))
+        logger.info("Библиотека примеров: %d", len(self._examples))
+
+    def add(self, question: str, sql: str, confidence: float) -> None:
+        """Добавление успешного запроса; индекс пересобирается в фоне"""
+        if not self.enabled or not self._add(question, sql, confidence):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._build(list(self._examples.values()))
+            return
+        if self._rebuild_task is None or self._rebuild_task.done():
+            self._rebuild_task = loop.create_task(self._rebuild_later())
+
+    def _add(self, question: str, sql: str, confidence: float) -> bool:
+        key = normalize_question(question)
+        if not key or not sql or (confidence or 0.0) < self.min_confidence:
+            return False
+        existing = self._examples.get(key)
+        if existing is not None and existing.sql == sql:
+            # Повтор того же запроса (например, из кэша) индекс не меняет
+            return False
+        grams = Counter(self._ngrams(key))
+        ids = [self._vocab.setdefault(gram, len(self._vocab)) for gram in grams]
+        self._examples.pop(key, None)
+        self._examples[key] = Example(
+            question=question,
+            sql=sql,
+            gram_ids=np.array(ids, dtype=np.int32),
+            counts=np.array(list(grams.values()), dtype=np.float32),
+        )
+        while len(self._examples) > self.max_examples:
+            self._examples.popitem(last=False)
+        return True
+
+    async def _rebuild_later(self):
+        # Примеры из нескольких запросов подряд попадают в одну пересборку
+        await asyncio.sleep(self.rebuild_delay)
+        started = time.perf_counter()
+        await asyncio.to_thread(self._build, list(self._examples.values()))
+        logger.debug("Индекс примеров пересобран за %.1f мс", (time.perf_counter() - started) * 1000)
+
+    @staticmethod
+    def _ngrams(text: str) -> List[str]:
+        padded = f" {text} "
+        return [padded[i:i + n] for n in NGRAM_SIZES for i in range(len(padded) - n + 1)]
+
+    def _build(self, examples: List[Example]) -> None:
+        """Векторный пересчёт TF-IDF весов по уже разобранным примерам"""
+        if not examples:
+            self._matrix = None
+            return
+        vocab_size = len(self._vocab)
+        lengths = np.array([len(example.gram_ids) for example in examples])
+        doc_ids = np.repeat(np.arange(len(examples), dtype=np.int32), lengths)
+        gram_ids = np.concatenate([example.gram_ids for example in examples])
+        tf = np.concatenate([example.counts for example in examples])
+
+        df = np.bincount(gram_ids, minlength=vocab_size)
+        idf = (np.log((1 + len(examples)) / (1 + df)) + 1).astype(np.float32)
+        weights = (1 + np.log(tf)) * idf[gram_ids]
+        norms = np.sqrt(np.bincount(doc_ids, weights=weights * weights, minlength=len(examples)))
+        weights = (weights / norms[doc_ids]).astype(np.float32)
+
+        order = np.argsort(gram_ids, kind="stable")
+        indptr = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(gram_ids, minlength=vocab_size), out=indptr[1:])
+        self._matrix = _Matrix(examples, idf, indptr, doc_ids[order], weights[order])
+
+    def search(self, question: str, top_k: Optional[int] = None) -> List[Tuple[str, str, float]]:
+        """Ближайшие примеры: [(вопрос, SQL, косинус)], от самых похожих"""
+        matrix = self._matrix
+        if matrix is None:
+            return []
+        top_k = self.top_k if top_k is None else top_k
+        if top_k <= 0:
+            return []
+
+        grams = Counter(
+            self._vocab[gram] for gram in self._ngrams(normalize_question(question))
+            if self._vocab.get(gram, len(matrix.idf)) < len(matrix.idf)
+        )
+        if not grams:
+            return []
+        ids = np.fromiter(grams.keys(), dtype=np.int64, count=len(grams))
+        query = (1 + np.log(np.fromiter(grams.values(), dtype=np.float32, count=len(grams)))) * matrix.idf[ids]
+        query /= np.linalg.norm(query)
+
+        starts, ends = matrix.indptr[ids], matrix.indptr[ids + 1]
+        docs = np.concatenate([matrix.doc_ids[s:e] for s, e in zip(starts, ends)])
+        contributions = np.concatenate([
+            matrix.weights[s:e] * weight for s, e, weight in zip(starts, ends, query)
+        ])
+        scores = np.bincount(docs, weights=contributions, minlength=len(matrix.examples))
+
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            (matrix.examples[i].question, matrix.examples[i].sql, round(float(scores[i]), 3))
+            for i in best if scores[i] >= self.min_score
+        ]
+
+    def prompt_block(self, question: str) -> str:
+        """Похожие выполненные запросы для сообщения пользователя"""
+        found = self.search(question)
+        if not found:
+            return ""
+        lines = ["ПОХОЖИЕ УСПЕШНЫЕ ЗАПРОСЫ:"]
+        lines.extend(f"{example_question} → {sql}" for example_question, sql, _ in found)
+        return "\n".join(lines)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "examples": len(self._examples),
+            "indexed": len(self._matrix.examples) if self._matrix is not None else 0,
+            "vocabulary": len(self._vocab),
+        }
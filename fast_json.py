@@ -0,0 +1,59 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # без orjson работает стандартный json, только медленнее
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    """Типы, которые не умеет кодировать сериализатор: значения asyncpg и модели"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, BaseModel):
+        # Без повторной валидации и model_dump — поля как есть
+        return {name: getattr(value, name) for name in type(value).model_fields}
+    if hasattr(value, "keys"):
+        # asyncpg.Record / sqlite3.Row
+        return dict(zip(value.keys(), value))
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    return str(value)
+
+
+def dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+def encode_records(records: Sequence[Any], result_format: str = "rows") -> Tuple[Optional[List[str]], List[Any]]:
+    """Строки результата в формате ответа
+
+    rows — список объектов {поле: значение}; columnar — имена полей один раз
+    (возвращаются отдельно) и строки как массивы значений.
+    """
+    if result_format == "columnar":
+        columns = list(records[0].keys()) if records else []
+        return columns, [tuple(record) for record in records]
+    return None, [dict(zip(record.keys(), record)) for record in records]
+
+
+class FastJSONResponse(Response):
+    """JSON-ответ без проверки через response_model и jsonable_encoder"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,327 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Set
+
+import metrics
+from query_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "queries-"
+# Файлы старого формата: один JSON на запрос (20240101_120000_000000.json)
+LEGACY_LOG_RE = re.compile(r"^\d{8}_\d{6}_\d{6}\.json$")
+
+
+class LogIndexEntry(NamedTuple):
+    """Положение записи в сегменте и поля, по которым ведётся поиск"""
+    timestamp: float
+    segment: str
+    offset: int
+    length: int
+    model: str
+    question: str
+
+
+class LogStore:
+    """Журнал запросов в append-only JSONL сегментах с индексом в памяти
+
+    Запись идёт пачками в фоновой задаче через поток, поэтому не блокирует
+    event loop. Индекс упорядочен по времени (поиск диапазона — bisect),
+    дополнительно хранятся позиции по модели и по словам вопроса.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.enabled = os.getenv("ENABLE_QUERY_LOGGING", "true").lower() == "true"
+        self.segment_max_bytes = int(os.getenv("LOG_SEGMENT_MAX_BYTES", 16 * 1024 * 1024))
+        self.retention_days = float(os.getenv("LOG_RETENTION_DAYS", 30))
+        # Число сегментов вместе с текущим
+        self.max_segments = max(1, int(os.getenv("LOG_MAX_SEGMENTS", 100)))
+        # Период проверки срока хранения, секунды
+        self.retention_interval = float(os.getenv("LOG_RETENTION_INTERVAL", 3600))
+        self.batch_size = int(os.getenv("LOG_BATCH_SIZE", 100))
+
+        # Глобальные номера записей: entries[i - first_id] — запись с номером i
+        self.entries: List[LogIndexEntry] = []
+        self.first_id = 0
+        self._timestamps: List[float] = []
+        self._by_model: Dict[str, List[int]] = {}
+        self._by_word: Dict[str, List[int]] = {}
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=int(os.getenv("LOG_RECENT_SIZE", 50)))
+
+        self._segment: Optional[Path] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._retention_task: Optional[asyncio.Task] = None
+        # Запись пачки и удаление сегментов не должны пересекаться
+        self._lock: Optional[asyncio.Lock] = None
+
+    # --- Жизненный цикл ---
+
+    async def initialize(self):
+        """Загрузка индекса существующих сегментов и запуск фоновой записи"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        await asyncio.to_thread(self._migrate_legacy)
+        entries, recent = await asyncio.to_thread(self._scan_segments)
+        for entry in entries:
+            self._add_to_index(entry)
+        self._recent.extend(recent)
+        self._lock = asyncio.Lock()
+        await self._prune()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._writer_loop())
+        self._retention_task = asyncio.create_task(self._retention_loop())
+        logger.info("Журнал запросов загружен: %d записей", len(self.entries))
+
+    async def close(self):
+        """Дописывает очередь и останавливает фоновую запись"""
+        if self._task is None:
+            return
+        await self._queue.join()
+        for task in (self._task, self._retention_task):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._retention_task = None
+
+    # --- Запись ---
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        """Постановка записи в очередь (без ожидания записи на диск)"""
+        if not self.enabled:
+            return
+        self._recent.append(entry)
+        if self._queue is None:
+            # Хранилище не запущено (скрипты, отладка) — пишем синхронно
+            for index_entry in self._write_batch([entry]):
+                self._add_to_index(index_entry)
+            return
+        self._queue.put_nowait(entry)
+
+    async def _writer_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                async with self._lock:
+                    with metrics.timed("log_flush", model=""):
+                        index_entries = await asyncio.to_thread(self._write_batch, batch)
+                    for index_entry in index_entries:
+                        self._add_to_index(index_entry)
+                    if self._segment_full():
+                        # Следующая пачка откроет новый сегмент
+                        self._segment = None
+                        await self._prune()
+            except Exception as e:
+                logger.warning("Не удалось сохранить лог: %s", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _retention_loop(self):
+        # Срок хранения соблюдается и при редкой записи, когда сегмент не заполняется
+        while True:
+            await asyncio.sleep(self.retention_interval)
+            try:
+                async with self._lock:
+                    await self._prune()
+            except Exception as e:
+                logger.warning("Не удалось удалить устаревшие сегменты журнала: %s", e)
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> List[LogIndexEntry]:
+        if self._segment is None:
+            self._segment = self._new_segment_path()
+
+        index_entries = []
+        with open(self._segment, "ab") as f:
+            offset = f.tell()
+            chunks = []
+            for entry in batch:
+                line = (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+                chunks.append(line)
+                index_entries.append(self._make_index_entry(entry, self._segment.name, offset, len(line)))
+                offset += len(line)
+            f.write(b"".join(chunks))
+        return index_entries
+
+    def _segment_full(self) -> bool:
+        return self._segment is not None and self._segment.stat().st_size >= self.segment_max_bytes
+
+    def _new_segment_path(self) -> Path:
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        return self.directory / f"{SEGMENT_PREFIX}{stamp}.jsonl"
+
+    async def _prune(self):
+        """Удаление сегментов старше срока хранения и сверх LOG_MAX_SEGMENTS
+
+        Текущий сегмент не удаляется и входит в max_segments; если его ещё
+        нет, место для него оставляется заранее.
+        """
+        segments = [p for p in self._segment_paths() if p != self._segment]
+        limit = self.max_segments - 1
+        cutoff = time.time() - self.retention_days * 86400
+        expired = [p for p in segments if p.stat().st_mtime < cutoff]
+        if len(segments) - len(expired) > limit:
+            expired = segments[:len(segments) - limit]
+        if not expired:
+            return
+
+        for path in expired:
+            await asyncio.to_thread(path.unlink)
+        expired_names = {p.name for p in expired}
+        remaining = [e for e in self.entries if e.segment not in expired_names]
+        self.first_id += len(self.entries) - len(remaining)
+        self._rebuild_index(remaining)
+        logger.info("Удалено сегментов журнала: %d", len(expired))
+
+    # --- Индекс ---
+
+    @staticmethod
+    def _make_index_entry(entry: Dict[str, Any], segment: str, offset: int, length: int) -> LogIndexEntry:
+        try:
+            timestamp = datetime.fromisoformat(entry["timestamp"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            timestamp = time.time()
+        return LogIndexEntry(
+            timestamp=timestamp,
+            segment=segment,
+            offset=offset,
+            length=length,
+            model=entry.get("model_used", ""),
+            question=entry.get("question", ""),
+        )
+
+    def _add_to_index(self, entry: LogIndexEntry) -> None:
+        entry_id = self.first_id + len(self.entries)
+        # Запись из пачки может оказаться чуть старше последней — сохраняем порядок
+        if self._timestamps and entry.timestamp < self._timestamps[-1]:
+            entry = entry._replace(timestamp=self._timestamps[-1])
+        self.entries.append(entry)
+        self._timestamps.append(entry.timestamp)
+        self._by_model.setdefault(entry.model, []).append(entry_id)
+        for word in set(normalize_question(entry.question).split()):
+            self._by_word.setdefault(word, []).append(entry_id)
+
+    def _rebuild_index(self, entries: List[LogIndexEntry]) -> None:
+        self.entries = []
+        self._timestamps = []
+        self._by_model = {}
+        self._by_word = {}
+        for entry in entries:
+            self._add_to_index(entry)
+
+    def _segment_paths(self) -> List[Path]:
+        return sorted(self.directory.glob(f"{SEGMENT_PREFIX}*.jsonl"))
+
+    def _scan_segments(self):
+        """Построение индекса по существующим сегментам"""
+        entries: List[LogIndexEntry] = []
+        recent: Deque[Dict[str, Any]] = deque(maxlen=self._recent.maxlen)
+        for path in self._segment_paths():
+            with open(path, "rb") as f:
+                offset = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning("Повреждённая строка в %s (смещение %d)", path.name, offset)
+                    else:
+                        entries.append(self._make_index_entry(entry, path.name, offset, len(line)))
+                        recent.append(entry)
+                    offset += len(line)
+        return entries, recent
+
+    def _migrate_legacy(self):
+        """Перенос логов старого формата (файл на запрос) в сегмент"""
+        legacy = sorted(p for p in self.directory.glob("*.json") if LEGACY_LOG_RE.match(p.name))
+        if not legacy:
+            return
+        batch = []
+        for path in legacy:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+                entry.pop("raw_response", None)
+                batch.append(entry)
+            except Exception as e:
+                logger.warning("Не удалось прочитать лог %s: %s", path, e)
+        self._segment = self.directory / f"{SEGMENT_PREFIX}00000000_legacy.jsonl"
+        self._write_batch(batch)
+        self._segment = None
+
+        archive = self.directory / "legacy"
+        archive.mkdir(exist_ok=True)
+        for path in legacy:
+            shutil.move(str(path), archive / path.name)
+        logger.info("Перенесено логов старого формата: %d", len(batch))
+
+    # --- Чтение ---
+
+    def recent(self, limit: int = 5) -> List[Dict[str, Any]]:
+        """Последние записи, от новых к старым"""
+        items = list(self._recent)[-limit:] if limit > 0 else []
+        return items[::-1]
+
+    async def search(
+        self,
+        question: Optional[str] = None,
+        model: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 20,
+    ) -> List[Dict[str, Any]]:
+        """Поиск по диапазону времени, модели и словам вопроса (новые первыми)"""
+        lo = bisect.bisect_left(self._timestamps, since) if since is not None else 0
+        hi = bisect.bisect_right(self._timestamps, until) if until is not None else len(self._timestamps)
+        lo_id, hi_id = self.first_id + lo, self.first_id + hi
+
+        candidates: Optional[Set[int]] = None
+        if model:
+            candidates = set(self._ids_in_range(self._by_model.get(model, []), lo_id, hi_id))
+        if question:
+            for word in normalize_question(question).split():
+                ids = set(self._ids_in_range(self._by_word.get(word, []), lo_id, hi_id))
+                candidates = ids if candidates is None else candidates & ids
+
+        if candidates is None:
+            selected = list(range(hi_id - 1, max(lo_id, hi_id - limit) - 1, -1))
+        else:
+            selected = sorted(candidates, reverse=True)[:limit]
+
+        index_entries = [self.entries[i - self.first_id] for i in selected]
+        return await asyncio.to_thread(self._read_entries, index_entries)
+
+    @staticmethod
+    def _ids_in_range(ids: List[int], lo_id: int, hi_id: int) -> List[int]:
+        return ids[bisect.bisect_left(ids, lo_id):bisect.bisect_left(ids, hi_id)]
+
+    def _read_entries(self, index_entries: List[LogIndexEntry]) -> List[Dict[str, Any]]:
+        result = []
+        for entry in index_entries:
+            try:
+                with open(self.directory / entry.segment, "rb") as f:
+                    f.seek(entry.offset)
+                    result.append(json.loads(f.read(entry.length)))
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning("Не удалось прочитать запись журнала %s@%d: %s", entry.segment, entry.offset, e)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "segments": len(self._segment_paths()),
+            "models": {model: len(ids) for model, ids in self._by_model.items()},
+        }
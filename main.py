@@ -1,18 +1,36 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi import Request
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field, ValidationError
 from contextlib import asynccontextmanager
 import os
 import logging
-from typing import List, Dict, Any
+from typing import Annotated, List, Dict, Any, Literal, Optional, AsyncIterator, Tuple
 from pathlib import Path
 from datetime import datetime
+import asyncio
+import base64
+import binascii
+import hashlib
+import hmac
 import json
+import secrets
+import time
 
-from sgr_schema import SQLGeneration, DATABASE_SCHEMA, EXAMPLE_QUERIES
+from sgr_schema import SCHEMA_TIERS, GenerationResult, parse_generation, schema_tier
 from database import DatabaseManager  
 from ollama_client import OllamaClient
+from model_registry import ModelRegistry
+from prompt_builder import PromptBuilder
+from query_cache import QueryCache, normalize_question
+from log_store import LogStore
+from entity_index import EntityIndex
+from example_library import ExampleLibrary
+from stream_parser import IncrementalJSONParser
+from single_flight import SingleFlight
+from fast_json import FastJSONResponse, dumps as fast_dumps, encode_records
+import metrics
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -21,19 +39,59 @@ logger = logging.getLogger(__name__)
 # Глобальные объекты
 db_manager = DatabaseManager()
 ollama_client = OllamaClient(os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"))
+model_registry = ModelRegistry(ollama_client)
+query_cache = QueryCache()
+# Известные значения объектов, номенклатуры, пользователей и заявок
+entity_index = EntityIndex(db_manager)
+# Статический системный префикс промпта собирается один раз при старте
+prompt_builder = PromptBuilder()
+# Похожие успешные запросы из журнала — динамические примеры после префикса
+example_library = ExampleLibrary()
+# Схемы структурированного вывода по уровням
+SGR_SCHEMAS = {tier: model.model_json_schema() for tier, model in SCHEMA_TIERS.items()}
+# Порядок попыток генерации: сначала компактная схема (меньше токенов вывода),
+# затем полная SGR — при низкой уверенности, ошибке валидации или SQL
+SGR_COMPACT_FIRST = os.getenv("SGR_COMPACT_FIRST", "true").lower() == "true"
+SGR_ESCALATE_CONFIDENCE = float(os.getenv("SGR_ESCALATE_CONFIDENCE", 0.7))
+SCHEMA_TIER_PLAN = ("compact", "full", "full") if SGR_COMPACT_FIRST else ("full", "full")
 BASE_DIR = Path(__file__).resolve().parent
 LOGS_DIR = BASE_DIR / "logs"
 LOGS_DIR.mkdir(exist_ok=True)
+log_store = LogStore(LOGS_DIR)
+# Размер страницы результатов, отдаваемой в ответе на запрос
+RESULTS_PAGE_SIZE = int(os.getenv("RESULTS_PAGE_SIZE", 100))
+# Предел строк выгрузки NDJSON (дополнительно действует бюджет строк уровня стоимости)
+EXPORT_MAX_ROWS = int(os.getenv("EXPORT_MAX_ROWS", 100000))
+# Ключ подписи токенов результата; без него ключ случайный и токены не переживают перезапуск
+RESULT_TOKEN_SECRET = (os.getenv("RESULT_TOKEN_SECRET") or secrets.token_hex(32)).encode("utf-8")
+# Одинаковые одновременные вопросы к одной модели генерируются один раз
+generation_flight = SingleFlight("llm")
+# Число одновременных задач на этапах конвейера /api/query/batch
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", 2))
+BATCH_DB_CONCURRENCY = int(os.getenv("BATCH_DB_CONCURRENCY", 4))
+BATCH_OUTPUT_CONCURRENCY = int(os.getenv("BATCH_OUTPUT_CONCURRENCY", 2))
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifecycle events for startup and shutdown"""
     await db_manager.initialize()
+    await entity_index.start()
+    await ollama_client.initialize()
+    await model_registry.start()
+    query_cache.load()
+    await log_store.initialize()
+    if example_library.enabled:
+        await example_library.load(await log_store.search(limit=example_library.max_examples))
     logger.info("Приложение запущено")
     try:
         yield
     finally:
+        await log_store.close()
+        query_cache.save()
+        await model_registry.stop()
+        await ollama_client.close()
+        await entity_index.stop()
         await db_manager.close()
 
 
@@ -42,20 +100,229 @@ app = FastAPI(title="Text2SQL POC с SGR", version="1.0.0", lifespan=lifespan)
 # Подключение статических файлов
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 
+
+STREAMING_PATHS = ("/api/query/stream", "/api/query/batch")
+
+
+@app.middleware("http")
+async def server_timing_middleware(request: Request, call_next):
+    """Сбор таймингов этапов запроса и заголовок Server-Timing
+
+    Этап total записывается в конвейере (finish_query / run_pipeline) с
+    меткой модели. Потоковым ответам заголовок не добавляется: call_next
+    возвращается до окончания генерации, и тайминги были бы неполными.
+    """
+    if not request.url.path.startswith("/api/query") or request.url.path in STREAMING_PATHS:
+        return await call_next(request)
+
+    timings = metrics.start_request()
+    response = await call_next(request)
+    header = timings.server_timing()
+    if header:
+        response.headers["Server-Timing"] = header
+    return response
+
+
+ResultFormat = Literal["rows", "columnar"]
+
 class QueryRequest(BaseModel):
     question: str = Field(..., min_length=1, max_length=500)
     model: str = "qwen3:32b"
+    # columnar — имена полей один раз в columns, строки как массивы
+    result_format: ResultFormat = "rows"
 
 class QueryResponse(BaseModel):
     sql_query: str
     explanation: str
     confidence: float
-    results: List[Dict[str, Any]] = Field(default_factory=list)
+    results: List[Any] = Field(default_factory=list)
+    columns: Optional[List[str]] = None
     execution_time_ms: int
     model_used: str
+    schema_tier: Optional[str] = None
+    result_token: Optional[str] = None
+    has_more: bool = False
+    total_estimate: Optional[int] = None
+    # Результат обрезан бюджетом строк уровня стоимости (row_cap строк)
+    truncated: bool = False
+    row_cap: Optional[int] = None
 
     model_config = {"protected_namespaces": ()}
 
+class BatchQueryRequest(BaseModel):
+    questions: List[Annotated[str, Field(min_length=1, max_length=500)]] = Field(..., min_length=1, max_length=500)
+    model: str = "qwen3:32b"
+    result_format: ResultFormat = "rows"
+
+class MultiQueryRequest(BaseModel):
+    question: str = Field(..., min_length=1, max_length=500)
+    models: List[str] = Field(default_factory=list)
+    mode: Literal["race", "compare"] = "race"
+
+class ModelOutcome(BaseModel):
+    model: str
+    status: Literal["ok", "error", "cancelled"]
+    elapsed_ms: Optional[int] = None
+    confidence: Optional[float] = None
+    row_count: Optional[int] = None
+    error: Optional[str] = None
+    response: Optional[QueryResponse] = None
+
+class MultiQueryResponse(BaseModel):
+    mode: Literal["race", "compare"]
+    winner: Optional[str] = None
+    outcomes: List[ModelOutcome]
+
+def write_log(
+    question: str,
+    sql_query: str,
+    results: List[Dict[str, Any]],
+    explanation: str,
+    confidence: float,
+    execution_time_ms: int,
+    model: str,
+    tier: Optional[str] = None,
+) -> None:
+    """Сохранение успешного запроса в журнал (запись на диск идёт в фоне)"""
+    example_library.add(question, sql_query, confidence)
+    with metrics.timed("log_write"):
+        log_store.append({
+            "timestamp": datetime.now().isoformat(),
+            "question": question,
+            "sql_query": sql_query,
+            "results": results,
+            "explanation": explanation,
+            "confidence": confidence,
+            "execution_time_ms": execution_time_ms,
+            "model_used": model,
+            "schema_tier": tier,
+        })
+
+
+async def run_cached_query(request: QueryRequest) -> Optional[Tuple[GenerationResult, List[Any], str]]:
+    """Выполнение SQL из кэша без обращения к LLM"""
+    cached = query_cache.get(request.question, request.model)
+    if cached is None:
+        return None
+
+    sgr_result = parse_generation(cached)
+    try:
+        query_results, executed_sql = await execute_first_page(sgr_result.sql_query)
+    except ValueError as e:
+        logger.warning("Кэшированный SQL не выполнился, запись удалена: %s", e)
+        query_cache.invalidate(request.question, request.model)
+        return None
+
+    logger.info("Cache hit: %s", request.question)
+    return sgr_result, query_results, executed_sql
+
+
+def _sign_sql(payload: bytes) -> str:
+    digest = hmac.new(RESULT_TOKEN_SECRET, payload, hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii")
+
+
+def encode_result_token(sql: str) -> str:
+    """Токен результата: по нему запрашиваются следующие страницы и выгрузка
+
+    SQL подписан HMAC ключом сервера — выполнить по токену можно только
+    запрос, который сервер выполнил сам, а не произвольный SQL клиента.
+    """
+    payload = sql.encode("utf-8")
+    return base64.urlsafe_b64encode(payload).decode("ascii") + "." + _sign_sql(payload)
+
+
+def decode_result_token(token: str) -> str:
+    try:
+        encoded, signature = token.split(".", 1)
+        payload = base64.urlsafe_b64decode(encoded.encode("ascii"))
+        if not hmac.compare_digest(signature, _sign_sql(payload)):
+            raise ValueError("подпись не совпадает")
+        return payload.decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Некорректный токен результата")
+
+
+async def execute_first_page(sql: str) -> Tuple[List[Any], str]:
+    """Первая страница результата (записи asyncpg); лишняя строка показывает, есть ли продолжение"""
+    return await db_manager.fetch_records(sql, limit=RESULTS_PAGE_SIZE + 1)
+
+
+def response_content(response: BaseModel) -> Dict[str, Any]:
+    """Поля ответа без model_dump и повторной валидации — для быстрой сериализации"""
+    return {name: getattr(response, name) for name in type(response).model_fields}
+
+
+async def finish_query(
+    request: QueryRequest,
+    sgr_result: GenerationResult,
+    records: List[Any],
+    executed_sql: str,
+    start_time: float,
+) -> QueryResponse:
+    """Формирование ответа и запись лога для успешно выполненного запроса
+
+    Записи БД кладутся в ответ без проверки pydantic (model_construct):
+    на тысячах строк валидация и jsonable_encoder дороже самого SQL.
+    """
+    entity_index.observe_sql(executed_sql)
+    has_more = len(records) > RESULTS_PAGE_SIZE
+    row_cap = db_manager.row_cap(executed_sql)
+    total_estimate = len(records)
+    if has_more or (row_cap is not None and len(records) >= row_cap):
+        # Оценка из плана уже в кэше DatabaseManager — EXPLAIN повторно не выполняется
+        estimate = await db_manager.estimate_count(executed_sql)
+        if has_more:
+            total_estimate = estimate
+        truncated = row_cap is not None and estimate is not None and estimate > row_cap
+    else:
+        truncated = False
+    if truncated:
+        # Больше row_cap строк не отдадут ни страницы, ни выгрузка
+        total_estimate = row_cap
+    records = records[:RESULTS_PAGE_SIZE]
+    with metrics.timed("row_conversion"):
+        columns, query_results = encode_records(records, request.result_format)
+    tier = schema_tier(sgr_result)
+    metrics.SCHEMA_TIER_TOTAL.inc(model=request.model, tier=tier)
+
+    execution_time = int((time.time() - start_time) * 1000)
+    metrics.record("total", time.time() - start_time, request.model)
+    logger.info(
+        "Executed SQL: %s | Execution time: %d ms",
+        executed_sql,
+        execution_time,
+    )
+    response = QueryResponse.model_construct(
+        sql_query=executed_sql,
+        explanation=sgr_result.explanation,
+        confidence=sgr_result.confidence_score,
+        results=query_results,
+        columns=columns,
+        execution_time_ms=execution_time,
+        model_used=request.model,
+        schema_tier=tier,
+        result_token=encode_result_token(executed_sql),
+        has_more=has_more,
+        total_estimate=total_estimate,
+        truncated=truncated,
+        row_cap=row_cap,
+    )
+
+    write_log(
+        question=request.question,
+        sql_query=executed_sql,
+        # В журнале строки всегда хранятся объектами
+        results=query_results if columns is None else [dict(zip(columns, row)) for row in query_results],
+        explanation=sgr_result.explanation,
+        confidence=sgr_result.confidence_score,
+        execution_time_ms=execution_time,
+        model=request.model,
+        tier=tier,
+    )
+    return response
+
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Главная страница"""
@@ -64,152 +331,667 @@ async def root():
         return HTMLResponse(f.read())
 
 @app.get("/api/models")
-async def get_available_models():
+async def get_available_models(refresh: bool = False):
     """Получение списка доступных моделей"""
-    available = []
-    for model in ollama_client.models:
-        is_available = await ollama_client.check_model_availability(model)
-        available.append({"name": model, "available": is_available})
-    return {"models": available}
+    if refresh:
+        await model_registry.refresh()
+    return model_registry.snapshot()
 
 
 @app.get("/api/history")
-async def get_history():
-    """Возврат последних 5 запросов"""
-    files = sorted(LOGS_DIR.glob("*.json"), reverse=True)[:5]
-    history = []
-    for file in files:
+async def get_history(limit: int = Query(5, ge=1, le=50)):
+    """Возврат последних запросов"""
+    return {"logs": log_store.recent(limit)}
+
+@app.get("/api/history/search")
+async def search_history(
+    q: Optional[str] = None,
+    model: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(20, ge=1, le=200),
+):
+    """Поиск по журналу запросов: слова вопроса, модель, период"""
+    logs = await log_store.search(
+        question=q,
+        model=model,
+        since=since.timestamp() if since else None,
+        until=until.timestamp() if until else None,
+        limit=limit,
+    )
+    return {"logs": logs}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Статистика кэша вопрос → SQL"""
+    return query_cache.stats()
+
+@app.get("/api/examples/stats")
+async def get_example_stats():
+    """Размер библиотеки примеров для динамического подбора"""
+    return example_library.stats()
+
+@app.get("/api/entities/stats")
+async def get_entity_stats():
+    """Размер индекса сущностей и рекомендации по pg_trgm индексам"""
+    return entity_index.stats()
+
+@app.get("/api/query/page")
+async def get_result_page(
+    token: str,
+    offset: int = Query(0, ge=0),
+    page_size: int = Query(RESULTS_PAGE_SIZE, ge=1),
+    result_format: ResultFormat = "rows",
+):
+    """Очередная страница результата выполненного запроса"""
+    sql = decode_result_token(token)
+    page_size = max(1, min(page_size, db_manager.max_results - 1))
+    try:
+        records, _ = await db_manager.fetch_records(sql, offset=offset, limit=page_size + 1)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    columns, rows = encode_records(records[:page_size], result_format)
+    return FastJSONResponse({
+        "results": rows,
+        "columns": columns,
+        "offset": offset,
+        "has_more": len(records) > page_size,
+    })
+
+@app.get("/api/query/export")
+async def export_results(token: str):
+    """Выгрузка результата в NDJSON частями по MAX_RESULTS строк
+
+    Каждая часть читается отдельным вызовом fetch_records — со своим
+    соединением, проверкой стоимости и statement_timeout, — поэтому медленная
+    загрузка клиентом не держит соединение пула. Первая часть читается до
+    ответа: отказ по стоимости или ошибка SQL возвращаются как 400.
+    """
+    sql = decode_result_token(token)
+    chunk_size = min(db_manager.max_results, EXPORT_MAX_ROWS)
+    try:
+        first, _ = await db_manager.fetch_records(sql, offset=0, limit=chunk_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def rows() -> AsyncIterator[bytes]:
+        records, offset, limit = first, 0, chunk_size
+        while True:
+            # Те же типы, что в /api/query и /api/query/page: числа и даты ISO
+            for record in records:
+                yield fast_dumps(record) + b"\n"
+            offset += len(records)
+            # Неполная часть — конец результата или бюджета строк уровня
+            if len(records) < limit or offset >= EXPORT_MAX_ROWS:
+                return
+            limit = min(chunk_size, EXPORT_MAX_ROWS - offset)
+            try:
+                records, _ = await db_manager.fetch_records(sql, offset=offset, limit=limit)
+            except ValueError as e:
+                # Заголовки уже отправлены — выгрузка обрывается
+                logger.warning("Выгрузка прервана на строке %d: %s", offset, e)
+                return
+
+    return StreamingResponse(
+        rows(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="results.ndjson"'},
+    )
+
+def _question_context(question: str) -> str:
+    blocks = (example_library.prompt_block(question), entity_index.prompt_hints(question))
+    return "\n\n".join(block for block in blocks if block)
+
+
+async def question_context(question: str) -> str:
+    """Зависящая от вопроса часть промпта: похожие примеры и известные значения
+
+    Поиск по индексам выполняется в потоке, чтобы не занимать event loop;
+    результат вычисляется один раз на вопрос и переиспользуется в попытках.
+    """
+    return await asyncio.to_thread(_question_context, question)
+
+
+async def generate_sql(
+    request: QueryRequest,
+    messages: List[Dict[str, str]],
+    error_message: Optional[str],
+    tier: str = "full",
+) -> Dict[str, Any]:
+    """Генерация SGR ответа моделью по схеме уровня tier
+
+    Ключ — нормализованный вопрос, модель, уровень схемы и ошибка предыдущей
+    попытки: при всплеске одинаковых вопросов на GPU уходит одна генерация.
+    """
+    key = (normalize_question(request.question), request.model, tier, error_message)
+    return await generation_flight.do(key, lambda: ollama_client.generate_structured(
+        model=request.model,
+        messages=messages,
+        schema=SGR_SCHEMAS[tier],
+        temperature=0.2,
+    ))
+
+
+class SchemaEscalation(Exception):
+    """Ответ по компактной схеме не принят — следующая попытка с полной SGR"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def escalate(request: QueryRequest, reason: str) -> SchemaEscalation:
+    metrics.SCHEMA_ESCALATIONS.inc(model=request.model, reason=reason)
+    logger.info("Переход на полную схему SGR (%s): %s", reason, request.question)
+    return SchemaEscalation(reason)
+
+
+def check_generation(request: QueryRequest, tier: str, result: Dict[str, Any]) -> GenerationResult:
+    """Валидация ответа модели по схеме своего уровня
+
+    Для компактной схемы ошибка валидации или низкая уверенность приводят к
+    SchemaEscalation; для полной ValidationError пробрасывается как есть.
+    """
+    try:
+        with metrics.timed("validation"):
+            sgr_result = SCHEMA_TIERS[tier](**result)
+    except ValidationError:
+        if tier != "compact":
+            raise
+        raise escalate(request, "validation")
+    if tier == "compact" and sgr_result.confidence_score < SGR_ESCALATE_CONFIDENCE:
+        raise escalate(request, "low_confidence")
+    return sgr_result
+
+
+async def generate_checked(
+    request: QueryRequest,
+    messages: List[Dict[str, str]],
+    error_message: Optional[str],
+    tier: str,
+) -> Tuple[Dict[str, Any], GenerationResult]:
+    """Генерация и проверка ответа модели
+
+    Некорректный JSON по компактной схеме, как и ошибка валидации, приводит
+    к SchemaEscalation (так же, как в потоковом режиме).
+    """
+    try:
+        result = await generate_sql(request, messages, error_message, tier)
+    except ValueError:
+        if tier != "compact":
+            raise
+        raise escalate(request, "validation")
+    return result, check_generation(request, tier, result)
+
+
+class QueryExecutionFailed(Exception):
+    """SQL не удалось выполнить ни с одной попытки"""
+
+    def __init__(self, message: str, last_sql: str):
+        super().__init__(message)
+        self.message = message
+        self.last_sql = last_sql
+
+
+async def run_pipeline(request: QueryRequest, start_time: Optional[float] = None) -> QueryResponse:
+    """Генерация SQL моделью и выполнение по плану SCHEMA_TIER_PLAN: компактная
+    схема, затем полная SGR (повторная попытка после ошибки SQL)
+
+    Ошибки валидации ответа модели пробрасываются как ValidationError,
+    неудача выполнения SQL — как QueryExecutionFailed.
+    """
+    start_time = time.time() if start_time is None else start_time
+    metrics.current_model.set(request.model)
+    try:
+        return await _run_pipeline(request, start_time)
+    except Exception:
+        # Успешный запрос учитывается в finish_query
+        metrics.record("total", time.time() - start_time, request.model)
+        raise
+
+
+async def _run_pipeline(request: QueryRequest, start_time: float) -> QueryResponse:
+    error_message = None
+    previous_response = None
+    last_sql = ""
+
+    cached = await run_cached_query(request)
+    if cached is not None:
+        return await finish_query(request, *cached, start_time)
+
+    hints = await question_context(request.question)
+    for tier in SCHEMA_TIER_PLAN:
+        messages = prompt_builder.build_messages(request.question, previous_response, error_message, hints)
+
+        logger.info("Prompt (%s): %s", tier, messages[1:])
+
         try:
-            with open(file, "r", encoding="utf-8") as f:
-                history.append(json.load(f))
-        except Exception as e:
-            logger.warning("Не удалось прочитать лог %s: %s", file, e)
-    return {"logs": history}
+            result, sgr_result = await generate_checked(request, messages, error_message, tier)
+        except SchemaEscalation:
+            continue
+        last_sql = sgr_result.sql_query
+
+        try:
+            query_results, executed_sql = await execute_first_page(
+                sgr_result.sql_query
+            )
+        except ValueError as e:
+            if tier == "compact":
+                escalate(request, "execution")
+            error_message = str(e)
+            previous_response = json.dumps(result, ensure_ascii=False)
+            logger.warning("SQL execution failed: %s", error_message)
+            continue
+
+        query_cache.set(request.question, request.model, sgr_result.model_dump())
+        return await finish_query(request, sgr_result, query_results, executed_sql, start_time)
+
+    raise QueryExecutionFailed(error_message, last_sql)
+
+
+def require_known_model(model: str) -> None:
+    """Отказ 400 для моделей, которых нет ни в конфигурации, ни в Ollama"""
+    if not model_registry.is_known(model):
+        raise HTTPException(status_code=400, detail=f"Неизвестная модель: {model}")
+
 
 @app.post("/api/query", response_model=QueryResponse)
 async def process_query(request: QueryRequest):
     """Обработка естественного запроса"""
-    import time
+    start_time = time.time()
+
+    logger.info("Model selected: %s", request.model)
+    require_known_model(request.model)
 
+    try:
+        response = await run_pipeline(request, start_time)
+        return FastJSONResponse(response_content(response))
+    except ValidationError as e:
+        logger.error(f"Ошибка валидации: {e}")
+        raise HTTPException(status_code=422, detail=e.errors())
+    except QueryExecutionFailed as e:
+        execution_time = int((time.time() - start_time) * 1000)
+        return QueryResponse(
+            sql_query=e.last_sql,
+            explanation=f"Не удалось выполнить запрос: {e.message}",
+            confidence=0.0,
+            results=[],
+            execution_time_ms=execution_time,
+            model_used=request.model,
+        )
+    except Exception as e:
+        logger.error(f"Ошибка обработки запроса: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+async def run_model_outcome(request: QueryRequest) -> ModelOutcome:
+    """Запуск конвейера для одной модели с замером времени; ошибки попадают в результат"""
     start_time = time.time()
+    try:
+        response = await run_pipeline(request, start_time)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        if isinstance(e, QueryExecutionFailed):
+            error = f"Не удалось выполнить запрос: {e.message}"
+        elif isinstance(e, ValidationError):
+            error = f"Ответ модели не прошёл валидацию: {e.error_count()} ошибок"
+        else:
+            error = str(e)
+        return ModelOutcome(
+            model=request.model,
+            status="error",
+            elapsed_ms=int((time.time() - start_time) * 1000),
+            error=error,
+        )
+    return ModelOutcome(
+        model=request.model,
+        status="ok",
+        elapsed_ms=response.execution_time_ms,
+        confidence=response.confidence,
+        row_count=response.total_estimate if response.has_more else len(response.results),
+        response=response,
+    )
 
-    # Общий шаблон промпта для SGR
-    base_prompt = f"""
-Ты эксперт по SQL и работе с базами данных. Твоя задача - преобразовать естественный запрос на русском языке в корректный SQL запрос.
 
-СХЕМА БАЗЫ ДАННЫХ:
-{DATABASE_SCHEMA}
+@app.post("/api/query/multi", response_model=MultiQueryResponse)
+async def process_query_multi(request: MultiQueryRequest):
+    """Один вопрос нескольким моделям одновременно
+
+    race — возвращается первый успешно выполненный результат, остальные
+    генерации отменяются; compare — собираются результаты всех моделей.
+    Ограничения параллелизма по моделям действуют как обычно.
+    """
+    models = request.models or model_registry.default_models()
+    for model in models:
+        require_known_model(model)
+    if not models:
+        raise HTTPException(status_code=400, detail="Нет доступных моделей")
+    logger.info("Multi-model %s: %s", request.mode, models)
+
+    tasks = {
+        asyncio.create_task(run_model_outcome(QueryRequest(question=request.question, model=model))): model
+        for model in models
+    }
+
+    if request.mode == "compare":
+        outcomes = await asyncio.gather(*tasks)
+        return FastJSONResponse(MultiQueryResponse(mode="compare", outcomes=list(outcomes)))
+
+    outcomes: List[ModelOutcome] = []
+    winner = None
+    pending = set(tasks)
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                outcome = task.result()
+                outcomes.append(outcome)
+                if outcome.status == "ok" and winner is None:
+                    winner = outcome.model
+    finally:
+        for task in pending:
+            task.cancel()
+    for task in pending:
+        outcomes.append(ModelOutcome(model=tasks[task], status="cancelled"))
 
-ПРИМЕРЫ ЗАПРОСОВ:
-{chr(10).join(EXAMPLE_QUERIES)}
+    return FastJSONResponse(MultiQueryResponse(mode="race", winner=winner, outcomes=outcomes))
 
-ПОЛЬЗОВАТЕЛЬСКИЙ ЗАПРОС: "{request.question}"
+def sse_event(event: str, data: Any) -> str:
+    """Форматирование Server-Sent Event"""
+    return f"event: {event}\ndata: {fast_dumps(data).decode('utf-8')}\n\n"
 
-Следуй Schema-Guided Reasoning подходу:
-1. Проанализируй запрос пользователя
-2. Определи стратегию построения SQL
-3. Сгенерируй корректный SQL запрос
-4. Объясни логику
 
-ВАЖНО:
-- Используй только SELECT запросы
-- Все названия полей в двойных кавычках
-- Для текстового поиска используй ILIKE '%term%'
-- Для номенклатуры ищи по двум полям: ("Nomenclature" ILIKE '%term%' OR "NomenclatureFullName" ILIKE '%term%')
-    - Для поиска пользователей ищи по трём полям: ("UserName" ILIKE '%term%' OR "PurchaseCardUserName" ILIKE '%term%' OR "PurchaseCardUserFio" ILIKE '%term%')
-- Не добавляй LIMIT если пользователь явно не просил ограничить результаты
-"""
+# Поля SGR, которые отправляются клиенту сразу после генерации
+STREAMED_FIELDS = ("analysis", "strategy", "sql_query")
 
-    # Получение схемы для структурированного вывода
-    schema = SQLGeneration.model_json_schema()
 
-    logger.info("Model selected: %s", request.model)
+async def stream_query_events(request: QueryRequest) -> AsyncIterator[str]:
+    """Потоковая обработка запроса: поля SGR и результаты отправляются по готовности"""
+    start_time = time.time()
+    metrics.current_model.set(request.model)
 
     error_message = None
+    previous_response = None
     last_sql = ""
 
     try:
-        for attempt in range(2):
-            prompt = base_prompt
-            if error_message:
-                prompt += f"\nПредыдущий SQL вызвал ошибку: {error_message}\nИсправь запрос с учётом этой ошибки."
-
-            logger.info("Prompt: %s", prompt)
+        cached = await run_cached_query(request)
+    except Exception as e:
+        logger.error(f"Ошибка обработки запроса: {e}", exc_info=True)
+        yield sse_event("error", {"detail": str(e)})
+        return
+
+    if cached is not None:
+        sgr_result, query_results, executed_sql = cached
+        dumped = sgr_result.model_dump()
+        for key in STREAMED_FIELDS:
+            if key in dumped:
+                yield sse_event(key, dumped[key])
+        response = await finish_query(request, sgr_result, query_results, executed_sql, start_time)
+        yield sse_event("result", response_content(response))
+        yield sse_event("done", {})
+        return
+
+    hints = await question_context(request.question)
+    for attempt, tier in enumerate(SCHEMA_TIER_PLAN):
+        messages = prompt_builder.build_messages(request.question, previous_response, error_message, hints)
+        parser = IncrementalJSONParser()
+        db_task: Optional[asyncio.Task] = None
 
-            result = await ollama_client.generate_structured(
+        try:
+            async for chunk in ollama_client.generate_structured_stream(
                 model=request.model,
-                prompt=prompt,
-                schema=schema,
+                messages=messages,
+                schema=SGR_SCHEMAS[tier],
                 temperature=0.2,
-            )
+            ):
+                for key, value in parser.feed(chunk):
+                    if key in STREAMED_FIELDS:
+                        yield sse_event(key, value)
+                    if key == "sql_query" and db_task is None:
+                        # Запускаем SQL, пока модель дописывает объяснение
+                        last_sql = value
+                        db_task = asyncio.create_task(execute_first_page(value))
 
             try:
-                sgr_result = SQLGeneration(**result)
-            except ValidationError as e:
+                try:
+                    data = json.loads(parser.buffer)
+                except json.JSONDecodeError:
+                    if tier == "compact":
+                        raise escalate(request, "validation")
+                    raise
+                sgr_result = check_generation(request, tier, data)
+            except SchemaEscalation as e:
+                yield sse_event("escalate", {"tier": "full", "reason": e.reason})
+                continue
+            except (ValidationError, json.JSONDecodeError) as e:
                 logger.error(f"Ошибка валидации: {e}")
-                raise HTTPException(status_code=422, detail=e.errors())
+                yield sse_event("error", {"detail": str(e)})
+                return
 
-            last_sql = sgr_result.sql_query
+            yield sse_event("explanation", {
+                "explanation": sgr_result.explanation,
+                "confidence": sgr_result.confidence_score,
+            })
+
+            if db_task is None or sgr_result.sql_query != last_sql:
+                last_sql = sgr_result.sql_query
+                db_task = asyncio.create_task(execute_first_page(last_sql))
 
             try:
-                query_results, executed_sql = await db_manager.execute_query(
-                    sgr_result.sql_query
-                )
+                query_results, executed_sql = await db_task
             except ValueError as e:
+                if tier == "compact":
+                    escalate(request, "execution")
                 error_message = str(e)
+                previous_response = parser.buffer
                 logger.warning("SQL execution failed: %s", error_message)
+                yield sse_event("retry", {
+                    "attempt": attempt + 1,
+                    "error": error_message,
+                    "errors": getattr(e, "errors", None),
+                })
                 continue
-
-            execution_time = int((time.time() - start_time) * 1000)
-            logger.info(
-                "Executed SQL: %s | Execution time: %d ms",
-                executed_sql,
-                execution_time,
-            )
-            response = QueryResponse(
-                sql_query=executed_sql,
-                explanation=sgr_result.explanation,
-                confidence=sgr_result.confidence_score,
-                results=query_results,
-                execution_time_ms=execution_time,
-                model_used=request.model,
-            )
-
-            log_entry = {
-                "timestamp": datetime.now().isoformat(),
-                "question": request.question,
-                "sql_query": executed_sql,
-                "raw_response": query_results,
-                "results": query_results,
-                "explanation": sgr_result.explanation,
-                "confidence": sgr_result.confidence_score,
-                "execution_time_ms": execution_time,
-                "model_used": request.model,
-            }
-            log_file = LOGS_DIR / f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.json"
-            try:
-                with open(log_file, "w", encoding="utf-8") as f:
-                    json.dump(log_entry, f, ensure_ascii=False, indent=2)
-            except Exception as e:
-                logger.warning("Не удалось сохранить лог: %s", e)
-
-            return response
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Ошибка обработки запроса: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+        except Exception as e:
+            logger.error(f"Ошибка обработки запроса: {e}", exc_info=True)
+            yield sse_event("error", {"detail": str(e)})
+            return
+        finally:
+            if db_task is not None:
+                if not db_task.done():
+                    db_task.cancel()
+                elif not db_task.cancelled():
+                    db_task.exception()  # помечаем исключение как обработанное
+
+        query_cache.set(request.question, request.model, sgr_result.model_dump())
+        response = await finish_query(request, sgr_result, query_results, executed_sql, start_time)
+        yield sse_event("result", response_content(response))
+        yield sse_event("done", {})
+        return
 
     execution_time = int((time.time() - start_time) * 1000)
-    return QueryResponse(
+    metrics.record("total", time.time() - start_time, request.model)
+    yield sse_event("result", QueryResponse(
         sql_query=last_sql,
         explanation=f"Не удалось выполнить запрос: {error_message}",
         confidence=0.0,
         results=[],
         execution_time_ms=execution_time,
         model_used=request.model,
+    ).model_dump())
+    yield sse_event("done", {})
+
+
+@app.post("/api/query/stream")
+async def process_query_stream(request: QueryRequest):
+    """Потоковая обработка запроса (Server-Sent Events)"""
+    logger.info("Model selected (stream): %s", request.model)
+    require_known_model(request.model)
+    return StreamingResponse(
+        stream_query_events(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+class BatchItem:
+    """Вопрос пакета и его состояние между этапами конвейера"""
+
+    def __init__(self, index: int, request: QueryRequest):
+        self.index = index
+        self.request = request
+        self.start_time: Optional[float] = None
+        # Номер попытки — позиция в SCHEMA_TIER_PLAN
+        self.attempt = 0
+        self.error_message: Optional[str] = None
+        self.previous_response: Optional[str] = None
+        # Примеры и известные значения для промпта: одни на все попытки
+        self.hints: Optional[str] = None
+        self.raw_result: Optional[Dict[str, Any]] = None
+        self.sgr_result: Optional[GenerationResult] = None
+        self.from_cache = False
+        self.records: List[Any] = []
+        self.executed_sql = ""
+
+
+def batch_line(item: BatchItem, response: Optional[QueryResponse] = None, error: Optional[str] = None) -> bytes:
+    """Строка NDJSON с результатом одного вопроса пакета"""
+    return fast_dumps({
+        "index": item.index,
+        "question": item.request.question,
+        "status": "error" if error is not None else "ok",
+        "response": response_content(response) if response is not None else None,
+        "error": error,
+        "sql_query": item.sgr_result.sql_query if item.sgr_result is not None else None,
+    }) + b"\n"
+
+
+async def batch_llm_stage(llm_queue: asyncio.Queue, db_queue: asyncio.Queue, done: asyncio.Queue):
+    """Этап генерации: SQL из кэша или от модели"""
+    while True:
+        item: BatchItem = await llm_queue.get()
+        request = item.request
+        metrics.current_model.set(request.model)
+        if item.start_time is None:
+            item.start_time = time.time()
+        try:
+            cached = query_cache.get(request.question, request.model) if item.error_message is None else None
+            if cached is not None:
+                item.sgr_result = parse_generation(cached)
+                item.from_cache = True
+            else:
+                if item.hints is None:
+                    item.hints = await question_context(request.question)
+                messages = prompt_builder.build_messages(
+                    request.question,
+                    item.previous_response,
+                    item.error_message,
+                    item.hints,
+                )
+                tier = SCHEMA_TIER_PLAN[item.attempt]
+                item.raw_result, item.sgr_result = await generate_checked(request, messages, item.error_message, tier)
+                item.from_cache = False
+        except SchemaEscalation:
+            item.attempt += 1
+            llm_queue.put_nowait(item)
+            continue
+        except ValidationError as e:
+            done.put_nowait(batch_line(item, error=f"Ответ модели не прошёл валидацию: {e.error_count()} ошибок"))
+            continue
+        except Exception as e:
+            logger.error(f"Ошибка генерации в пакете: {e}", exc_info=True)
+            done.put_nowait(batch_line(item, error=str(e)))
+            continue
+        db_queue.put_nowait(item)
+
+
+async def batch_db_stage(db_queue: asyncio.Queue, llm_queue: asyncio.Queue, output_queue: asyncio.Queue, done: asyncio.Queue):
+    """Этап выполнения SQL; после ошибки вопрос возвращается на генерацию"""
+    while True:
+        item: BatchItem = await db_queue.get()
+        request = item.request
+        metrics.current_model.set(request.model)
+        try:
+            item.records, item.executed_sql = await execute_first_page(item.sgr_result.sql_query)
+        except ValueError as e:
+            if item.from_cache:
+                logger.warning("Кэшированный SQL не выполнился, запись удалена: %s", e)
+                query_cache.invalidate(request.question, request.model)
+                item.from_cache = False
+                llm_queue.put_nowait(item)
+                continue
+            if SCHEMA_TIER_PLAN[item.attempt] == "compact":
+                escalate(request, "execution")
+            item.attempt += 1
+            if item.attempt < len(SCHEMA_TIER_PLAN):
+                item.error_message = str(e)
+                item.previous_response = json.dumps(item.raw_result, ensure_ascii=False)
+                logger.warning("SQL execution failed: %s", item.error_message)
+                llm_queue.put_nowait(item)
+            else:
+                done.put_nowait(batch_line(item, error=f"Не удалось выполнить запрос: {e}"))
+            continue
+        except Exception as e:
+            logger.error(f"Ошибка выполнения SQL в пакете: {e}", exc_info=True)
+            done.put_nowait(batch_line(item, error=str(e)))
+            continue
+        if not item.from_cache:
+            query_cache.set(request.question, request.model, item.sgr_result.model_dump())
+        output_queue.put_nowait(item)
+
+
+async def batch_output_stage(output_queue: asyncio.Queue, done: asyncio.Queue):
+    """Этап ответа: оценка числа строк, запись в журнал и сериализация"""
+    while True:
+        item: BatchItem = await output_queue.get()
+        metrics.current_model.set(item.request.model)
+        try:
+            response = await finish_query(item.request, item.sgr_result, item.records, item.executed_sql, item.start_time)
+            line = batch_line(item, response=response)
+        except Exception as e:
+            logger.error(f"Ошибка формирования ответа в пакете: {e}", exc_info=True)
+            line = batch_line(item, error=str(e))
+        done.put_nowait(line)
+
+
+async def batch_query_lines(request: BatchQueryRequest) -> AsyncIterator[bytes]:
+    """Конвейер пакета: пока модель генерирует вопрос N+1, БД выполняет N,
+    а запись и сериализация обрабатывают N-1. Строки отдаются по готовности."""
+    llm_queue: asyncio.Queue = asyncio.Queue()
+    db_queue: asyncio.Queue = asyncio.Queue()
+    output_queue: asyncio.Queue = asyncio.Queue()
+    done: asyncio.Queue = asyncio.Queue()
+    for index, question in enumerate(request.questions):
+        llm_queue.put_nowait(BatchItem(index, QueryRequest(
+            question=question, model=request.model, result_format=request.result_format,
+        )))
+
+    workers = (
+        [asyncio.create_task(batch_llm_stage(llm_queue, db_queue, done)) for _ in range(BATCH_LLM_CONCURRENCY)]
+        + [asyncio.create_task(batch_db_stage(db_queue, llm_queue, output_queue, done)) for _ in range(BATCH_DB_CONCURRENCY)]
+        + [asyncio.create_task(batch_output_stage(output_queue, done)) for _ in range(BATCH_OUTPUT_CONCURRENCY)]
     )
+    try:
+        for _ in request.questions:
+            yield await done.get()
+    finally:
+        # Клиент отключился или пакет завершён — останавливаем этапы
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
+@app.post("/api/query/batch")
+async def process_query_batch(request: BatchQueryRequest):
+    """Пакет вопросов одним запросом; результаты в NDJSON по мере готовности (поле index — позиция вопроса)"""
+    logger.info("Batch: %d вопросов, модель %s", len(request.questions), request.model)
+    require_known_model(request.model)
+    return StreamingResponse(batch_query_lines(request), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,181 @@
+import bisect
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Границы корзин гистограмм длительностей, секунды
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter:
+    """Счётчик в формате Prometheus"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Для каждой комбинации меток: счётчики по корзинам, сумма, количество
+        self._series: Dict[Tuple[str, ...], List] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            inf_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+REGISTRY: List = []
+
+STAGE_SECONDS = Histogram(
+    "text2sql_stage_seconds",
+    "Длительность этапов конвейера (prompt_eval, generation, validation, db, ...)",
+    ("stage", "model"),
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "text2sql_ollama_queue_wait_seconds",
+    "Ожидание свободного слота генерации для модели",
+    ("model",),
+)
+TOKENS_PER_SECOND = Histogram(
+    "text2sql_generation_tokens_per_second",
+    "Скорость генерации токенов по данным Ollama",
+    ("model",),
+    buckets=TOKENS_PER_SECOND_BUCKETS,
+)
+PROMPT_TOKENS = Counter("text2sql_prompt_tokens_total", "Токены промпта (prompt_eval_count)", ("model",))
+COMPLETION_TOKENS = Counter("text2sql_completion_tokens_total", "Сгенерированные токены (eval_count)", ("model",))
+SCHEMA_TIER_TOTAL = Counter(
+    "text2sql_schema_tier_total",
+    "Успешные ответы по уровню схемы генерации (compact / full)",
+    ("model", "tier"),
+)
+SCHEMA_ESCALATIONS = Counter(
+    "text2sql_schema_escalations_total",
+    "Переходы с компактной схемы на полную SGR по причине",
+    ("model", "reason"),
+)
+COALESCED_CALLS = Counter(
+    "text2sql_coalesced_calls_total",
+    "Вызовы, присоединившиеся к уже выполняемому одинаковому (single-flight)",
+    ("stage",),
+)
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Тайминги текущего HTTP запроса (для заголовка Server-Timing) ---
+
+class RequestTimings:
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+
+_request_timings: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+# Модель, для которой выполняется текущая задача (метка гистограмм)
+current_model: ContextVar[str] = ContextVar("current_model", default="")
+
+
+def start_request() -> RequestTimings:
+    timings = RequestTimings()
+    _request_timings.set(timings)
+    return timings
+
+
+def record(stage: str, seconds: float, model: Optional[str] = None) -> None:
+    """Учёт длительности этапа в гистограмме и в таймингах текущего запроса"""
+    STAGE_SECONDS.observe(seconds, stage=stage, model=model if model is not None else current_model.get())
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def timed(stage: str, model: Optional[str] = None) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, model)
+
+
+def record_ollama_stats(model: str, result: Dict) -> None:
+    """Учёт статистики из финального ответа Ollama (длительности в наносекундах)"""
+    prompt_eval = result.get("prompt_eval_duration")
+    if prompt_eval:
+        record("prompt_eval", prompt_eval / 1e9, model)
+    eval_duration = result.get("eval_duration")
+    if eval_duration:
+        record("generation", eval_duration / 1e9, model)
+    if result.get("prompt_eval_count"):
+        PROMPT_TOKENS.inc(result["prompt_eval_count"], model=model)
+    eval_count = result.get("eval_count")
+    if eval_count:
+        COMPLETION_TOKENS.inc(eval_count, model=model)
+        if eval_duration:
+            TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9), model=model)
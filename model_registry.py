@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+from ollama_client import OllamaClient
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """Кэш списка моделей Ollama с фоновым обновлением
+
+    /api/tags и /api/ps запрашиваются раз в refresh_interval секунд, а
+    /api/models отдаётся из памяти.
+    """
+
+    def __init__(self, client: OllamaClient, refresh_interval: float = None):
+        self.client = client
+        self.refresh_interval = (
+            refresh_interval if refresh_interval is not None
+            else float(os.getenv("MODEL_REFRESH_INTERVAL", 60))
+        )
+        self.configured = list(client.models)
+        self.installed: Dict[str, Dict[str, Any]] = {}
+        self.running: Dict[str, Dict[str, Any]] = {}
+        self.refreshed_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Первичная загрузка и запуск фонового обновления"""
+        await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("Ошибка фонового обновления моделей: %s", e)
+
+    async def refresh(self):
+        """Обновление списка установленных и загруженных моделей"""
+        tags, running = await asyncio.gather(
+            self.client.list_models(),
+            self.client.list_running(),
+            return_exceptions=True,
+        )
+        if isinstance(tags, Exception):
+            self.last_error = str(tags)
+            logger.warning("Не удалось получить список моделей Ollama: %s", tags)
+            return
+
+        self.installed = {m["name"]: m for m in tags}
+        # /api/ps может отсутствовать в старых версиях Ollama — это не критично
+        self.running = {} if isinstance(running, Exception) else {m["name"]: m for m in running}
+        self.refreshed_at = time.time()
+        self.last_error = None
+
+        # Клиент работает с найденными моделями, сохраняя порядок из конфигурации
+        self.client.models = self.configured + [name for name in self.installed if name not in self.configured]
+
+    def _resolve(self, name: str, models: Dict[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        # "qwen3" в конфигурации соответствует "qwen3:latest" в Ollama
+        if name in models:
+            return models[name]
+        return next((m for key, m in models.items() if key.startswith(name)), None)
+
+    def is_available(self, name: str) -> bool:
+        return self._resolve(name, self.installed) is not None
+
+    def is_known(self, name: str) -> bool:
+        """Модель из конфигурации или найденная в Ollama
+
+        Имя модели приходит от клиента и становится меткой метрик и ключом
+        семафора, поэтому произвольные имена до них не допускаются.
+        """
+        # Без префиксного сопоставления is_available: "q" не должно проходить как "qwen3:32b"
+        return name in self.client.models or name in self.installed or f"{name}:latest" in self.installed
+
+    def default_models(self) -> List[str]:
+        """Модели для запроса без явного списка: доступные из OLLAMA_MODELS
+
+        Найденные в Ollama модели (среди них бывают embedding-модели)
+        используются, только если в конфигурации ничего не задано.
+        """
+        candidates = self.configured or list(self.installed)
+        return [name for name in candidates if self.is_available(name)]
+
+    def models(self) -> List[Dict[str, Any]]:
+        result = []
+        for name in self.client.models:
+            info = self._resolve(name, self.installed) or {}
+            running = self._resolve(name, self.running)
+            details = info.get("details", {})
+            result.append({
+                "name": name,
+                "available": bool(info),
+                "loaded": running is not None,
+                "size": info.get("size"),
+                "parameter_size": details.get("parameter_size"),
+                "quantization": details.get("quantization_level"),
+                "size_vram": running.get("size_vram") if running else None,
+                "expires_at": running.get("expires_at") if running else None,
+            })
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "models": self.models(),
+            "refreshed_at": self.refreshed_at,
+            "error": self.last_error,
+        }
@@ -1,58 +1,176 @@
+import asyncio
+from contextlib import asynccontextmanager
+import os
 import httpx
 import json
-from typing import Dict, Any
+from typing import AsyncIterator, Dict, Any, List, Optional
 import logging
+import time
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
+
+def _parse_model_map(value: Optional[str], cast=int) -> Dict[str, Any]:
+    """Разбор строки вида "qwen3:32b=1,gpt-oss:20b=2" в словарь"""
+    result: Dict[str, Any] = {}
+    if not value:
+        return result
+    for item in value.split(","):
+        item = item.strip()
+        if not item or "=" not in item:
+            continue
+        # Имя модели может содержать ':' и '/', поэтому делим по последнему '='
+        name, raw = item.rsplit("=", 1)
+        try:
+            result[name.strip()] = cast(raw.strip())
+        except ValueError:
+            logger.warning("Некорректное значение для модели %s: %s", name, raw)
+    return result
+
+
 class OllamaClient:
     def __init__(self, base_url: str = "http://localhost:11434"):
         self.base_url = base_url
-        self.models = [
-            "deepseek-r1:32b",
-            "qwen3:32b",
-            "gpt-oss:20b",
-            "fomenks/T-Pro-1.0-it-q4_k_m:latest",
-        ]
-    
-    async def generate_structured(self, model: str, prompt: str, schema: Dict[str, Any], temperature: float = 0.2) -> Dict[str, Any]:
+        # Модели из конфигурации; установленные в Ollama модели добавляет ModelRegistry
+        self.models = [m.strip() for m in os.getenv("OLLAMA_MODELS", "").split(",") if m.strip()]
+
+        # Таймауты и ограничения параллелизма (по умолчанию и для отдельных моделей)
+        self.timeout = float(os.getenv("OLLAMA_TIMEOUT", 120))
+        self.connect_timeout = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", 10))
+        self.default_concurrency = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 2))
+        self.model_concurrency: Dict[str, int] = _parse_model_map(os.getenv("OLLAMA_MODEL_CONCURRENCY"))
+        self.model_timeouts: Dict[str, float] = _parse_model_map(os.getenv("OLLAMA_MODEL_TIMEOUTS"), float)
+        self.max_connections = int(os.getenv("OLLAMA_MAX_CONNECTIONS", 20))
+        # Сколько модель (и её KV-кэш префикса) остаётся в памяти после запроса
+        self.keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+        self.client: Optional[httpx.AsyncClient] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    async def initialize(self):
+        """Создание общего HTTP клиента с keep-alive соединениями"""
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+            logger.info("HTTP клиент Ollama создан (%s)", self.base_url)
+
+    async def close(self):
+        """Закрытие HTTP клиента"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def _get_client(self) -> httpx.AsyncClient:
+        # Клиент создаётся лениво, если initialize() не вызывался (скрипты, отладка)
+        if self.client is None:
+            await self.initialize()
+        return self.client
+
+    def get_semaphore(self, model: str) -> asyncio.Semaphore:
+        """Семафор, ограничивающий число одновременных генераций для модели"""
+        semaphore = self._semaphores.get(model)
+        if semaphore is None:
+            limit = self.model_concurrency.get(model, self.default_concurrency)
+            semaphore = asyncio.Semaphore(max(1, limit))
+            self._semaphores[model] = semaphore
+        return semaphore
+
+    @asynccontextmanager
+    async def _acquire_slot(self, model: str) -> AsyncIterator[None]:
+        """Занимает слот генерации модели, учитывая время ожидания в очереди"""
+        semaphore = self.get_semaphore(model)
+        start = time.perf_counter()
+        async with semaphore:
+            wait = time.perf_counter() - start
+            metrics.QUEUE_WAIT_SECONDS.observe(wait, model=model)
+            metrics.record("queue_wait", wait, model)
+            yield
+
+    def get_timeout(self, model: str) -> httpx.Timeout:
+        return httpx.Timeout(self.model_timeouts.get(model, self.timeout), connect=self.connect_timeout)
+
+    def _build_payload(self, model: str, messages: List[Dict[str, str]], schema: Dict[str, Any], temperature: float, stream: bool) -> Dict[str, Any]:
+        return {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+            "format": schema,
+            "keep_alive": self.keep_alive,
+            "options": {
+                "temperature": temperature,
+                "top_p": 0.9,
+                "num_ctx": 8192
+            }
+        }
+
+    async def generate_structured(self, model: str, messages: List[Dict[str, str]], schema: Dict[str, Any], temperature: float = 0.2) -> Dict[str, Any]:
         """Генерация с структурированным выводом"""
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                payload = {
-                    "model": model,
-                    "prompt": prompt,
-                    "stream": False,
-                    "format": schema,
-                    "options": {
-                        "temperature": temperature,
-                        "top_p": 0.9,
-                        "num_ctx": 8192
-                    }
-                }
-                
-                response = await client.post(f"{self.base_url}/api/generate", json=payload)
-                response.raise_for_status()
-                
-                result = response.json()
-                try:
-                    return json.loads(result["response"])
-                except json.JSONDecodeError as e:
-                    logger.error(f"Некорректный JSON в ответе модели: {result.get('response')}")
-                    raise ValueError("Модель вернула некорректный JSON") from e
-                
+            client = await self._get_client()
+            payload = self._build_payload(model, messages, schema, temperature, stream=False)
+
+            async with self._acquire_slot(model):
+                with metrics.timed("llm", model):
+                    response = await client.post("/api/chat", json=payload, timeout=self.get_timeout(model))
+            response.raise_for_status()
+
+            result = response.json()
+            metrics.record_ollama_stats(model, result)
+            content = result.get("message", {}).get("content", "")
+            try:
+                return json.loads(content)
+            except json.JSONDecodeError as e:
+                logger.error(f"Некорректный JSON в ответе модели: {content}")
+                raise ValueError("Модель вернула некорректный JSON") from e
+
         except Exception as e:
             logger.error(f"Ошибка генерации с моделью {model}: {e}")
             raise
 
-    async def check_model_availability(self, model: str) -> bool:
-        """Проверка доступности модели"""
+    async def generate_structured_stream(self, model: str, messages: List[Dict[str, str]], schema: Dict[str, Any], temperature: float = 0.2) -> AsyncIterator[str]:
+        """Потоковая генерация: отдаёт фрагменты JSON-ответа по мере их появления"""
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                if response.status_code == 200:
-                    models = response.json().get("models", [])
-                    return any(m["name"].startswith(model) for m in models)
-                return False
-        except:
-            return False
+            client = await self._get_client()
+            payload = self._build_payload(model, messages, schema, temperature, stream=True)
+
+            async with self._acquire_slot(model):
+                async with client.stream("POST", "/api/chat", json=payload, timeout=self.get_timeout(model)) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        data = json.loads(line)
+                        if data.get("error"):
+                            raise ValueError(f"Ollama: {data['error']}")
+                        content = data.get("message", {}).get("content")
+                        if content:
+                            yield content
+                        if data.get("done"):
+                            metrics.record_ollama_stats(model, data)
+                            break
+
+        except Exception as e:
+            logger.error(f"Ошибка потоковой генерации с моделью {model}: {e}")
+            raise
+
+    async def list_models(self) -> List[Dict[str, Any]]:
+        """Список установленных моделей (/api/tags)"""
+        client = await self._get_client()
+        response = await client.get("/api/tags", timeout=self.connect_timeout)
+        response.raise_for_status()
+        return response.json().get("models", [])
+
+    async def list_running(self) -> List[Dict[str, Any]]:
+        """Список моделей, загруженных в память (/api/ps)"""
+        client = await self._get_client()
+        response = await client.get("/api/ps", timeout=self.connect_timeout)
+        response.raise_for_status()
+        return response.json().get("models", [])
@@ -0,0 +1,67 @@
+from typing import Dict, List, Optional
+
+from sgr_schema import DATABASE_SCHEMA, EXAMPLE_QUERIES
+
+
+class PromptBuilder:
+    """Построение сообщений для /api/chat
+
+    Системное сообщение (схема, примеры, правила) собирается один раз и
+    остаётся побайтно одинаковым для всех запросов, а вопрос пользователя
+    идёт последним. Так Ollama переиспользует KV-кэш общего префикса.
+    """
+
+    def __init__(self, schema: str = DATABASE_SCHEMA, examples: Optional[List[str]] = None):
+        examples = EXAMPLE_QUERIES if examples is None else examples
+        self.system_prompt = f"""Ты эксперт по SQL и работе с базами данных. Твоя задача - преобразовать естественный запрос на русском языке в корректный SQL запрос.
+
+СХЕМА БАЗЫ ДАННЫХ:
+{schema}
+
+ПРИМЕРЫ ЗАПРОСОВ:
+{chr(10).join(examples)}
+
+Следуй Schema-Guided Reasoning подходу:
+1. Проанализируй запрос пользователя
+2. Определи стратегию построения SQL
+3. Сгенерируй корректный SQL запрос
+4. Объясни логику
+
+ВАЖНО:
+- Используй только SELECT запросы
+- Все названия полей в двойных кавычках
+- Для текстового поиска используй ILIKE '%term%'
+- Для номенклатуры ищи по двум полям: ("Nomenclature" ILIKE '%term%' OR "NomenclatureFullName" ILIKE '%term%')
+- Для поиска пользователей ищи по трём полям: ("UserName" ILIKE '%term%' OR "PurchaseCardUserName" ILIKE '%term%' OR "PurchaseCardUserFio" ILIKE '%term%')
+- Не добавляй LIMIT если пользователь явно не просил ограничить результаты
+"""
+
+    def build_messages(
+        self,
+        question: str,
+        previous_response: Optional[str] = None,
+        error_message: Optional[str] = None,
+        hints: str = "",
+    ) -> List[Dict[str, str]]:
+        """Сообщения для генерации; при повторе предыдущий ответ модели
+        добавляется в историю, чтобы весь первый диалог остался префиксом.
+
+        hints — похожие примеры и известные значения из индекса сущностей; они
+        зависят от вопроса, поэтому идут в сообщение пользователя, а не в
+        системный префикс.
+        """
+        user_content = f'ПОЛЬЗОВАТЕЛЬСКИЙ ЗАПРОС: "{question}"'
+        if hints:
+            user_content = f"{hints}\n\n{user_content}"
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_content},
+        ]
+        if error_message:
+            if previous_response:
+                messages.append({"role": "assistant", "content": previous_response})
+            messages.append({
+                "role": "user",
+                "content": f"Предыдущий SQL вызвал ошибку: {error_message}\nИсправь запрос с учётом этой ошибки.",
+            })
+        return messages
@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """Приведение вопроса к каноническому виду для ключа кэша"""
+    text = question.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class QueryCache:
+    """LRU-кэш вопрос → SQLGeneration с TTL и опциональным сохранением на диск
+
+    Значения хранятся в виде словарей (model_dump() ответа компактной или
+    полной схемы, см. sgr_schema.parse_generation), чтобы их можно было
+    сохранить в JSON без дополнительных преобразований.
+    """
+
+    def __init__(self, max_size: int = None, ttl: float = None, path: Optional[str] = None):
+        self.max_size = max_size if max_size is not None else int(os.getenv("QUERY_CACHE_SIZE", 1000))
+        self.ttl = ttl if ttl is not None else float(os.getenv("QUERY_CACHE_TTL", 86400))
+        path = path if path is not None else os.getenv("QUERY_CACHE_PATH")
+        self.path = Path(path) if path else None
+
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(question: str, model: str) -> Tuple[str, str]:
+        return normalize_question(question), model
+
+    def get(self, question: str, model: str) -> Optional[Dict[str, Any]]:
+        key = self.make_key(question, model)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        stored_at, value = entry
+        if self.ttl > 0 and time.time() - stored_at > self.ttl:
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, question: str, model: str, value: Dict[str, Any]) -> None:
+        if self.max_size <= 0:
+            return
+        key = self.make_key(question, model)
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, question: str, model: str) -> None:
+        self._entries.pop(self.make_key(question, model), None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "persistent": self.path is not None,
+        }
+
+    def load(self) -> None:
+        """Загрузка кэша с диска (если задан QUERY_CACHE_PATH)"""
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                items = json.load(f)
+        except Exception as e:
+            logger.warning("Не удалось загрузить кэш запросов %s: %s", self.path, e)
+            return
+
+        now = time.time()
+        for item in items:
+            if self.ttl > 0 and now - item["stored_at"] > self.ttl:
+                continue
+            key = (item["question"], item["model"])
+            self._entries[key] = (item["stored_at"], item["value"])
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        logger.info("Кэш запросов загружен: %d записей", len(self._entries))
+
+    def save(self) -> None:
+        """Сохранение кэша на диск (если задан QUERY_CACHE_PATH)"""
+        if self.path is None:
+            return
+        items = [
+            {"question": question, "model": model, "stored_at": stored_at, "value": value}
+            for (question, model), (stored_at, value) in self._entries.items()
+        ]
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning("Не удалось сохранить кэш запросов %s: %s", self.path, e)
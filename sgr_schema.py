@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Literal, Optional, List
+from typing import Any, Dict, Literal, Optional, List, Union
 from datetime import datetime
 
 class QueryAnalysis(BaseModel):
@@ -28,6 +28,32 @@ class SQLGeneration(BaseModel):
     confidence_score: float = Field(ge=0.0, le=1.0, description="Уверенность в корректности от 0 до 1")
     potential_issues: Optional[str] = Field(description="Возможные проблемы или ограничения")
 
+class SQLGenerationCompact(BaseModel):
+    """Компактная генерация: только SQL, краткое объяснение и уверенность
+
+    Используется первой: без analysis и strategy модель выводит в разы
+    меньше токенов. При низкой уверенности или ошибке — полная SQLGeneration.
+    """
+    sql_query: str = Field(description="Готовый SQL запрос для PostgreSQL")
+    explanation: str = Field(description="Краткое объяснение логики запроса на русском, одно предложение")
+    confidence_score: float = Field(ge=0.0, le=1.0, description="Уверенность в корректности от 0 до 1")
+
+GenerationResult = Union[SQLGeneration, SQLGenerationCompact]
+
+# Уровни схемы структурированного вывода
+SCHEMA_TIERS = {
+    "compact": SQLGenerationCompact,
+    "full": SQLGeneration,
+}
+
+def parse_generation(data: Dict[str, Any]) -> GenerationResult:
+    """Ответ модели или запись кэша → модель соответствующего уровня схемы"""
+    tier = "full" if "analysis" in data else "compact"
+    return SCHEMA_TIERS[tier](**data)
+
+def schema_tier(result: GenerationResult) -> str:
+    return "compact" if isinstance(result, SQLGenerationCompact) else "full"
+
 # Схема базы данных для промптов
 DATABASE_SCHEMA = """
 Таблица: "PurchaseAllView" (PostgreSQL)
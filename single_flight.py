@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Объединение одинаковых одновременных вызовов в один
+
+    Первый вызов с ключом запускает работу в отдельной задаче, остальные
+    ждут ту же задачу и получают тот же результат или то же исключение.
+    Отмена одного ожидающего не прерывает работу, пока её ждут другие;
+    когда уходит последний — задача отменяется.
+    """
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda done, key=key: self._forget(key, done))
+        else:
+            metrics.COALESCED_CALLS.inc(stage=self.stage)
+            logger.info("Single-flight (%s): ожидание уже выполняемого вызова", self.stage)
+
+        self._waiters[key] += 1
+        try:
+            # shield: отмена ожидающего не должна отменять общую работу
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(key) == 1 and self._calls.get(key) is task:
+                # Никто больше не ждёт — освобождаем ключ сразу, чтобы новый
+                # вызов не присоединился к отменяемой задаче
+                self._forget(key, task)
+                task.cancel()
+            raise
+        finally:
+            if self._calls.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+
+    def in_flight(self) -> int:
+        return len(self._calls)
@@ -1,4 +1,8 @@
 let currentResults = null;
+let pager = null;
+
+const TABLE_PAGE_SIZE = 20;
+const FETCH_PAGE_SIZE = 100;
 
 function escape(str) {
     return String(str)
@@ -39,12 +43,23 @@ async function checkModelsAvailability() {
         const select = document.getElementById('model-select');
         const status = document.getElementById('model-status');
         
+        // Добавляем в список модели, найденные в Ollama
+        const known = new Set(Array.from(select.options).map(o => o.value));
+        data.models.forEach(m => {
+            if (!known.has(m.name)) {
+                const option = document.createElement('option');
+                option.value = m.name;
+                option.textContent = m.parameter_size ? `${m.name} (${m.parameter_size})` : m.name;
+                select.appendChild(option);
+            }
+        });
+        
         // Обновляем статус текущей модели
         const currentModel = select.value;
         const modelInfo = data.models.find(m => m.name === currentModel);
         
         if (modelInfo && modelInfo.available) {
-            status.textContent = '✅ Доступна';
+            status.textContent = modelInfo.loaded ? '✅ Доступна (загружена в память)' : '✅ Доступна';
             status.className = 'status-available';
         } else {
             status.textContent = '❌ Недоступна';
@@ -68,21 +83,30 @@ async function submitQuery() {
     }
     
     const model = document.getElementById('model-select').value;
+    const mode = document.getElementById('mode-select').value;
     
     // Показываем загрузку
+    document.querySelector('#loading p').textContent = 'Генерирую SQL запрос...';
     document.getElementById('loading').style.display = 'block';
     document.getElementById('results').style.display = 'none';
     document.getElementById('submit-btn').disabled = true;
     
     try {
-        const response = await fetch('/api/query', {
+        if (mode !== 'single') {
+            await submitMultiQuery(question, mode);
+            await loadHistory();
+            return;
+        }
+
+        const response = await fetch('/api/query/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
             body: JSON.stringify({
                 question: question,
-                model: model
+                model: model,
+                result_format: 'columnar'
             })
         });
         
@@ -90,12 +114,7 @@ async function submitQuery() {
             throw new Error(`HTTP ${response.status}: ${response.statusText}`);
         }
         
-        const result = await response.json();
-        result.question = question;
-        result.timestamp = new Date().toISOString();
-        result.raw_response = result.results;
-        currentResults = result;
-        displayResults(result);
+        await readEventStream(response, (event, data) => handleStreamEvent(event, data, question));
         await loadHistory();
         
     } catch (error) {
@@ -107,6 +126,129 @@ async function submitQuery() {
     }
 }
 
+// Один вопрос нескольким моделям: гонка или сравнение
+async function submitMultiQuery(question, mode) {
+    document.querySelector('#loading p').textContent =
+        mode === 'race' ? 'Модели соревнуются...' : 'Собираю ответы всех моделей...';
+
+    const response = await fetch('/api/query/multi', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            question: question,
+            mode: mode
+        })
+    });
+
+    if (!response.ok) {
+        throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+    }
+
+    const data = await response.json();
+    const best = data.outcomes.find(o => o.model === data.winner)
+        || data.outcomes.filter(o => o.status === 'ok').sort((a, b) => b.confidence - a.confidence)[0];
+
+    if (best) {
+        const result = best.response;
+        result.question = question;
+        result.timestamp = new Date().toISOString();
+        result.raw_response = result.results;
+        currentResults = result;
+        displayResults(result);
+    } else {
+        document.getElementById('results').style.display = 'block';
+    }
+
+    document.getElementById('compare-table').innerHTML = createCompareTable(data);
+    document.getElementById('compare-tab-btn').style.display = '';
+    showTab('compare', null);
+}
+
+function createCompareTable(data) {
+    const statusText = { ok: '✅', error: '❌', cancelled: '⏹ отменена' };
+    let html = '<div class="data-table"><table><thead><tr>';
+    html += '<th>Модель</th><th>Статус</th><th>Время, мс</th><th>Уверенность</th><th>Строк</th><th>SQL / ошибка</th>';
+    html += '</tr></thead><tbody>';
+    data.outcomes.forEach(o => {
+        const winner = o.model === data.winner ? ' 🏆' : '';
+        const detail = o.response ? o.response.sql_query : (o.error || '');
+        html += '<tr>';
+        html += `<td>${escape(o.model)}${winner}</td>`;
+        html += `<td>${statusText[o.status] || o.status}</td>`;
+        html += `<td>${o.elapsed_ms ?? '-'}</td>`;
+        html += `<td>${o.confidence !== null && o.confidence !== undefined ? Math.round(o.confidence * 100) + '%' : '-'}</td>`;
+        html += `<td>${o.row_count ?? '-'}</td>`;
+        html += `<td><code>${escape(detail)}</code></td>`;
+        html += '</tr>';
+    });
+    html += '</tbody></table></div>';
+    return html;
+}
+
+// Чтение потока Server-Sent Events из ответа fetch
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const raw = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let event = 'message';
+            let data = '';
+            raw.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) event = line.slice(7);
+                else if (line.startsWith('data: ')) data += line.slice(6);
+            });
+            onEvent(event, data ? JSON.parse(data) : null);
+        }
+    }
+}
+
+// Промежуточные поля SGR показываем сразу, не дожидаясь результата
+function handleStreamEvent(event, data, question) {
+    const loadingText = document.querySelector('#loading p');
+    switch (event) {
+        case 'analysis':
+            loadingText.textContent = `Анализ: ${data.user_intent}`;
+            break;
+        case 'strategy':
+            loadingText.textContent = `Стратегия: ${data.query_type}. Генерирую SQL...`;
+            break;
+        case 'sql_query':
+            document.getElementById('sql-query').textContent = formatSQL(data);
+            loadingText.textContent = 'Выполняю SQL запрос...';
+            break;
+        case 'explanation':
+            document.getElementById('explanation-text').textContent = data.explanation;
+            break;
+        case 'escalate':
+            loadingText.textContent = 'Уточняю запрос с полным анализом (SGR)...';
+            break;
+        case 'retry':
+            loadingText.textContent = `Ошибка SQL, повторная генерация: ${data.error}`;
+            break;
+        case 'result':
+            data.question = question;
+            data.timestamp = new Date().toISOString();
+            data.raw_response = data.columns ? { columns: data.columns, rows: data.results } : data.results;
+            currentResults = data;
+            displayResults(data);
+            break;
+        case 'error':
+            throw new Error(typeof data.detail === 'string' ? data.detail : JSON.stringify(data.detail));
+    }
+}
+
 // Отображение результатов
 function displayResults(result) {
     document.getElementById('explanation-text').textContent = result.explanation;
@@ -122,7 +264,7 @@ function displayResults(result) {
         <p><strong>Дата:</strong> ${dt.toLocaleDateString()}</p>
         <p><strong>Время:</strong> ${dt.toLocaleTimeString()}</p>
         <p><strong>Запрос пользователя:</strong> ${escape(result.question || '')}</p>
-        <p><strong>Найдено записей:</strong> ${result.results.length}</p>
+        <p><strong>Найдено записей:</strong> ${formatTotal(result)}</p>
         <p><strong>Время выполнения:</strong> ${result.execution_time_ms} мс</p>
         <p><strong>Модель:</strong> ${result.model_used}</p>
     `;
@@ -132,36 +274,114 @@ function displayResults(result) {
     document.getElementById('raw-response').textContent = JSON.stringify(raw, null, 2);
     
     // Таблица данных
-    if (result.results.length > 0) {
-        const table = createDataTable(result.results);
-        document.getElementById('data-table').innerHTML = table;
-    } else {
-        document.getElementById('data-table').innerHTML = '<p>Данные не найдены</p>';
-    }
+    const table = toColumnar(result);
+    pager = {
+        token: result.result_token,
+        columns: table.columns,
+        rows: table.rows,
+        hasMore: Boolean(result.has_more),
+        total: result.total_estimate,
+        rowCap: result.truncated ? result.row_cap : null,
+        offset: 0,
+    };
+    renderPage();
     
     // Показываем результаты
+    document.getElementById('compare-tab-btn').style.display = 'none';
     document.getElementById('results').style.display = 'block';
     showTab('explanation', null);
 }
 
+// Строки в колоночном виде: имена полей один раз, строки — массивы значений.
+// Ответ с result_format=columnar уже в этом виде, журнал и multi — объектами.
+function toColumnar(result) {
+    if (result.columns) {
+        return { columns: result.columns, rows: result.results.slice() };
+    }
+    const columns = result.results.length ? Object.keys(result.results[0]) : [];
+    return { columns, rows: result.results.map(row => columns.map(column => row[column])) };
+}
+
+function formatTotal(result) {
+    if (result.truncated) {
+        return `первые ${result.row_cap} (результат ограничен бюджетом строк)`;
+    }
+    if (result.has_more) {
+        return result.total_estimate ? `~${result.total_estimate}` : `более ${result.results.length}`;
+    }
+    return result.results.length;
+}
+
+// Отрисовка текущей страницы таблицы
+function renderPage() {
+    const container = document.getElementById('data-table');
+    if (pager.rows.length === 0) {
+        container.innerHTML = '<p>Данные не найдены</p>';
+        return;
+    }
+
+    const pageRows = pager.rows.slice(pager.offset, pager.offset + TABLE_PAGE_SIZE);
+    const last = pager.offset + pageRows.length;
+    let total = pager.hasMore ? (pager.total ? `~${pager.total}` : `${pager.rows.length}+`) : pager.rows.length;
+    if (pager.rowCap) {
+        total = `${pager.rowCap} (ограничено бюджетом строк)`;
+    }
+
+    let html = createDataTable(pager.columns, pageRows);
+    html += '<div class="pager">';
+    html += `<button onclick="changePage(-1)" ${pager.offset === 0 ? 'disabled' : ''}>◀ Назад</button>`;
+    html += `<span>Строки ${pager.offset + 1}–${last} из ${total}</span>`;
+    html += `<button onclick="changePage(1)" ${!pager.hasMore && last >= pager.rows.length ? 'disabled' : ''}>Вперёд ▶</button>`;
+    if (pager.token) {
+        html += `<a href="/api/query/export?token=${encodeURIComponent(pager.token)}">⬇ NDJSON</a>`;
+    }
+    html += '</div>';
+    container.innerHTML = html;
+}
+
+// Переход по страницам; недостающие строки догружаются с сервера
+async function changePage(delta) {
+    const newOffset = pager.offset + delta * TABLE_PAGE_SIZE;
+    if (newOffset < 0) return;
+
+    if (newOffset + TABLE_PAGE_SIZE > pager.rows.length && pager.hasMore && pager.token) {
+        try {
+            const params = new URLSearchParams({
+                token: pager.token,
+                offset: pager.rows.length,
+                page_size: FETCH_PAGE_SIZE,
+                result_format: 'columnar',
+            });
+            const response = await fetch(`/api/query/page?${params}`);
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+            }
+            const data = await response.json();
+            pager.rows.push(...data.results);
+            pager.hasMore = data.has_more;
+        } catch (error) {
+            console.error('Ошибка загрузки страницы:', error);
+        }
+    }
+
+    if (newOffset >= pager.rows.length) return;
+    pager.offset = newOffset;
+    renderPage();
+}
+
 // Создание таблицы данных
-function createDataTable(data) {
-    if (data.length === 0) return '<p>Нет данных</p>';
-    
-    const headers = Object.keys(data[0]);
-    const maxRows = Math.min(data.length, 20); // Ограничиваем до 20 строк
+function createDataTable(columns, rows) {
+    if (rows.length === 0) return '<p>Нет данных</p>';
     
     let html = '<div class="data-table"><table><thead><tr>';
-    headers.forEach(header => {
+    columns.forEach(header => {
         html += `<th>${header}</th>`;
     });
     html += '</tr></thead><tbody>';
     
-    for (let i = 0; i < maxRows; i++) {
-        const row = data[i];
+    rows.forEach(row => {
         html += '<tr>';
-        headers.forEach(header => {
-            let value = row[header];
+        row.forEach(value => {
             if (value === null || value === undefined) {
                 value = '-';
             } else if (typeof value === 'string' && value.length > 50) {
@@ -170,14 +390,9 @@ function createDataTable(data) {
             html += `<td>${escape(value)}</td>`;
         });
         html += '</tr>';
-    }
+    });
     
     html += '</tbody></table></div>';
-    
-    if (data.length > maxRows) {
-        html += `<p><em>Показано ${maxRows} из ${data.length} записей</em></p>`;
-    }
-    
     return html;
 }
 
@@ -0,0 +1,65 @@
+import json
+from typing import Any, Dict, List, Tuple
+
+
+class IncrementalJSONParser:
+    """Инкрементальный разбор JSON-объекта верхнего уровня
+
+    Принимает текст по частям (как его выдаёт модель в потоковом режиме) и
+    возвращает поля верхнего уровня сразу, как только их значение завершено.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = None
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """Добавляет очередной фрагмент и возвращает завершённые поля"""
+        self.buffer += chunk
+        completed: List[Tuple[str, Any]] = []
+
+        while self._pos < len(self.buffer):
+            char = self.buffer[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._member_start = self._pos + 1
+            elif char in "}]":
+                if self._depth == 1:
+                    completed.extend(self._close_member(self._pos))
+                self._depth -= 1
+            elif char == "," and self._depth == 1:
+                completed.extend(self._close_member(self._pos))
+                self._member_start = self._pos + 1
+
+            self._pos += 1
+
+        return completed
+
+    @property
+    def done(self) -> bool:
+        return self._member_start is not None and self._depth == 0
+
+    def _close_member(self, end: int) -> List[Tuple[str, Any]]:
+        segment = self.buffer[self._member_start:end].strip()
+        if not segment:
+            return []
+        # Сегмент имеет вид "ключ": значение — разбираем его как объект из одного поля
+        member = json.loads("{" + segment + "}")
+        self.fields.update(member)
+        return list(member.items())
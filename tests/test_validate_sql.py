@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DatabaseManager, SQLValidationError, validate_sql  # noqa: E402
+
+
+def codes(sql):
+    return {error["code"] for error in validate_sql(sql)}
+
+
+@pytest.mark.parametrize("sql", [
+    'SELECT "ObjectName" FROM "PurchaseAllView" WHERE "ObjectName" ILIKE \'%лампа%\' LIMIT 100',
+    'SELECT * FROM public."PurchaseAllView" LIMIT 10',
+    'SELECT p."ObjectName" FROM "public"."PurchaseAllView" p LIMIT 10',
+    'SELECT COUNT(*) AS total FROM "PurchaseAllView" WHERE EXTRACT(YEAR FROM "OrderDate") = 2024',
+    'SELECT "UserName", COUNT(*) FROM "PurchaseAllView" GROUP BY "UserName" ORDER BY COUNT(*) DESC',
+    'SELECT * FROM (SELECT "ObjectName" FROM "PurchaseAllView") AS t LIMIT 5',
+    'WITH recent AS (SELECT * FROM "PurchaseAllView" LIMIT 10) SELECT * FROM recent',
+    'SELECT a."ObjectName" FROM "PurchaseAllView" a JOIN "PurchaseAllView" b ON a."GlobalUid" = b."GlobalUid"',
+    'SELECT ROUND(SUM("Quantity")::numeric(12, 2), 2) FROM "PurchaseAllView"',
+    'SELECT "ObjectName" FROM "PurchaseAllView" WHERE "ObjectName" = E\'it\\\'s\'',
+    'WITH a AS (SELECT * FROM "PurchaseAllView"), b AS MATERIALIZED (SELECT * FROM a) SELECT * FROM b',
+    'SELECT TRIM(BOTH \' \' FROM "ObjectName") FROM "PurchaseAllView"',
+])
+def test_allowed_queries(sql):
+    assert validate_sql(sql) == []
+
+
+@pytest.mark.parametrize("sql", [
+    'SELECT * FROM "PurchaseAllView", pg_shadow',
+    'SELECT * FROM "PurchaseAllView" p, pg_catalog.pg_authid a',
+    'SELECT * FROM "PurchaseAllView" JOIN pg_shadow ON true',
+    'SELECT * FROM "PurchaseAllView" WHERE "ObjectName" IN (SELECT usename FROM pg_shadow)',
+    'SELECT * FROM other_schema."PurchaseAllView"',
+    'SELECT * FROM "PurchaseAllView", generate_series(1, 10)',
+    'SELECT b.query FROM ("PurchaseAllView" a JOIN pg_catalog.pg_stat_activity b ON true)',
+    'SELECT * FROM ("PurchaseAllView" a JOIN information_schema.tables t ON true)',
+    'SELECT * FROM "PurchaseAllView" CROSS JOIN (pg_user CROSS JOIN pg_roles)',
+    'SELECT * FROM "PurchaseAllView" WHERE "ObjectName" IN ((SELECT \'a\') UNION SELECT usename FROM pg_user)',
+    # Экранированная кавычка в E'...' не закрывает строку
+    'SELECT "ObjectName" FROM "PurchaseAllView" WHERE "ObjectName" <> E\'\\\'\' UNION SELECT usename FROM pg_user --\'',
+    # Имя окна не объявляет CTE
+    'SELECT u.usename FROM "PurchaseAllView", pg_user u WINDOW pg_user AS (ORDER BY 1)',
+])
+def test_unknown_sources(sql):
+    assert "unknown_table" in codes(sql)
+
+
+@pytest.mark.parametrize("sql", [
+    'SELECT query_to_xml(\'select * from pg_shadow\', true, true, \'\') FROM "PurchaseAllView"',
+    'SELECT current_setting(\'data_directory\') FROM "PurchaseAllView"',
+    'SELECT pg_stat_file(\'/etc/passwd\') FROM "PurchaseAllView"',
+    'SELECT lo_get(1) FROM "PurchaseAllView"',
+    'SELECT pg_sleep(10) FROM "PurchaseAllView"',
+    'SELECT "pg_sleep"(10) FROM "PurchaseAllView"',
+    # Псевдоним или имя CTE не делают функцию разрешённой
+    'SELECT "ObjectName" AS pg_read_file, pg_read_file(\'/etc/passwd\') FROM "PurchaseAllView"',
+    'WITH pg_sleep AS (SELECT * FROM "PurchaseAllView") SELECT pg_sleep(5) FROM pg_sleep',
+])
+def test_forbidden_functions(sql):
+    assert "forbidden_function" in codes(sql)
+
+
+def test_multiple_statements():
+    assert "multiple_statements" in codes('SELECT * FROM "PurchaseAllView"; DROP TABLE x')
+
+
+def test_table_statement():
+    assert codes("TABLE pg_shadow") & {"not_select", "forbidden"}
+
+
+def test_prepare_query_rejects_escaped_string_injection():
+    sql = 'SELECT "ObjectName" FROM "PurchaseAllView" WHERE "ObjectName" <> E\'\\\'\' UNION SELECT usename FROM pg_user --\''
+    with pytest.raises(SQLValidationError):
+        DatabaseManager().prepare_query(sql)